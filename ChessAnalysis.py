@@ -0,0 +1,212 @@
+# Batch analysis of game collections. Every position of every game is searched to a fixed depth by a
+# pool of worker processes and one JSON line per game is written as soon as all its positions are done.
+# Positions are deduplicated by zobrist key before they are handed out (openings repeat across thousands
+# of games) and results are kept in an SQLite cache keyed by (key, depth), so reruns and overlapping
+# collections only search positions they haven't seen.
+#
+#   python ChessAnalysis.py games.pgn --depth 4 --workers 8 > analysis.jsonl
+#   python ChessAnalysis.py games.bin --cache analysis.sqlite      a ChessRecords game file
+#
+# Scores are in centipawns from white's point of view.
+
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+
+import ChessEngine
+import ChessPGN
+from ChessRecords import GAME_MAGIC, GameFile, pack_position, unpack_position
+from ChessSearch import Search, MATE_SCORE
+
+DEFAULT_CACHE = "analysis_cache.sqlite"
+WINDOW_GAMES = 256  # games replayed and deduplicated together before their positions are handed out
+WORKER_HASH_MB = 16
+
+
+# results of earlier searches, (score, best move in UCI or "", nodes) by (zobrist key, depth)
+class AnalysisCache:
+    def __init__(self, path=DEFAULT_CACHE):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS analysis (key INTEGER NOT NULL, depth INTEGER NOT NULL, "
+                                "score INTEGER NOT NULL, best TEXT NOT NULL, nodes INTEGER NOT NULL, "
+                                "PRIMARY KEY (key, depth)) WITHOUT ROWID")
+        self.hits = 0
+        self.misses = 0
+
+    # SQLite integers are signed 64-bit
+    @staticmethod
+    def signed(key):
+        return key - (1 << 64) if key >= 1 << 63 else key
+
+    def get(self, key, depth):
+        row = self.connection.execute("SELECT score, best, nodes FROM analysis WHERE key = ? AND depth = ?",
+                                      (self.signed(key), depth)).fetchone()
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row
+
+    def put(self, key, depth, result):
+        self.connection.execute("INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)",
+                                (self.signed(key), depth) + tuple(result))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+
+# the positions of one game: its index, headers, played moves and (key, packed position) before each
+# move and after the last one
+class GameJob:
+    def __init__(self, index, headers, gs):
+        self.index = index
+        self.headers = headers
+        self.moves = []  # (uci, san) of each move
+        self.positions = []
+        self.white_to_move = []
+        played = list(gs.move_log)
+        for _ in played:
+            gs.undo_move()
+        for move in played + [None]:
+            self.positions.append((gs.zobrist_key, pack_position(gs)))
+            self.white_to_move.append(gs.white_to_move)
+            if move is not None:
+                self.moves.append((move.get_uci_notation(), ChessPGN.to_san(gs, move)))
+                gs.make_move(move)
+        self.remaining = 0  # positions still being searched
+
+    # the JSON line of the finished game, results maps zobrist keys to (score, best, nodes)
+    def output(self, results):
+        plies = []
+        for ply, (key, _) in enumerate(self.positions):
+            score, best, nodes = results[key]
+            if not self.white_to_move[ply]:
+                score = -score
+            entry = {'ply': ply, 'score': score, 'best': best}
+            if ply < len(self.moves):
+                entry['move'], entry['san'] = self.moves[ply]
+            plies.append(entry)
+        return json.dumps({'game': self.index, 'headers': self.headers, 'plies': plies})
+
+
+# state of a pool worker process
+_worker_search = None
+_worker_gs = None
+
+
+def _init_worker(hash_mb):
+    global _worker_search, _worker_gs
+    _worker_search = Search(hash_mb=hash_mb)
+    _worker_gs = ChessEngine.GameState()
+
+
+# searches one packed position, returns (key, (score for the side to move, best move, nodes))
+def _analyse_position(task):
+    key, record, depth = task
+    gs = unpack_position(record, 0, _worker_gs)
+    move = _worker_search.search(gs, float('inf'), depth)
+    if move is None:  # checkmate or stalemate
+        return key, (-MATE_SCORE if gs.is_in_check() else 0, "", 0)
+    return key, (_worker_search.info[-1]['score'], move.get_uci_notation(), _worker_search.nodes)
+
+
+# yields (headers, GameState played through the game) from a PGN or ChessRecords game file
+def read_collection(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(GAME_MAGIC))
+    if magic == GAME_MAGIC:
+        with GameFile(path) as games:
+            for i in range(len(games)):
+                yield {}, games.game_state(i)
+    else:
+        yield from ChessPGN.read_game_states(path)
+
+
+# analyses games (any iterable of (headers, GameState)) to depth and calls emit with the JSON line of each
+# game as it finishes. Returns (games, positions, unique positions searched)
+def analyse_games(games, depth, cache, emit, workers=None, window=WINDOW_GAMES):
+    totals = [0, 0, 0]
+    with multiprocessing.Pool(workers or os.cpu_count(), _init_worker, (WORKER_HASH_MB,)) as pool:
+        batch = []
+        for index, (headers, gs) in enumerate(games):
+            batch.append(GameJob(index, headers, gs))
+            if len(batch) == window:
+                analyse_window(batch, depth, cache, emit, pool, totals)
+                batch = []
+        if batch:
+            analyse_window(batch, depth, cache, emit, pool, totals)
+    return tuple(totals)
+
+
+def analyse_window(jobs, depth, cache, emit, pool, totals):
+    results = {}
+    needed = {}  # key -> packed position of every position to search
+    waiting = {}  # key -> jobs waiting for it
+    for job in jobs:
+        totals[0] += 1
+        totals[1] += len(job.positions)
+        for key, record in job.positions:
+            if key in results:
+                continue
+            if key not in needed:
+                cached = cache.get(key, depth)
+                if cached is not None:
+                    results[key] = cached
+                    continue
+                needed[key] = record
+            if job not in waiting.setdefault(key, []):
+                waiting[key].append(job)
+                job.remaining += 1
+    for job in jobs:
+        if not job.remaining:
+            emit(job.output(results))
+    totals[2] += len(needed)
+
+    tasks = ((key, record, depth) for key, record in needed.items())
+    for key, result in pool.imap_unordered(_analyse_position, tasks, chunksize=4):
+        results[key] = result
+        cache.put(key, depth, result)
+        for job in waiting[key]:
+            job.remaining -= 1
+            if not job.remaining:
+                emit(job.output(results))
+    cache.commit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse every position of a game collection")
+    parser.add_argument("games", help="PGN file or ChessRecords game file")
+    parser.add_argument("--depth", type=int, default=4, help="search depth for every position")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="SQLite result cache, ':memory:' for none")
+    parser.add_argument("--out", default=None, help="write the JSON lines here instead of stdout")
+    args = parser.parse_args(argv)
+
+    out = open(args.out, 'w') if args.out else sys.stdout
+
+    def emit(line):
+        out.write(line + "\n")
+        out.flush()
+
+    cache = AnalysisCache(args.cache)
+    try:
+        games, positions, searched = analyse_games(read_collection(args.games), args.depth, cache, emit,
+                                                   args.workers)
+    finally:
+        cache.close()
+        if out is not sys.stdout:
+            out.close()
+    print("games %d  positions %d  searched %d  cache hits %d" % (games, positions, searched, cache.hits),
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# Batch evaluation of many positions at once with NumPy. Positions are packed into an N x 12 x 64 tensor
+# of piece planes (plane order as ChessBitboard.PIECES, squares as row * 8 + col) and scored in one
+# vectorised pass against ChessEvaluation.PIECE_SQUARE_VALUES, the same table ChessEvaluation.evaluate
+# walks for a single position, so batch and single scores always agree.
+#
+# Needs numpy, which the rest of the engine does not.
+
+import numpy as np
+
+from ChessEvaluation import PIECE_SQUARE_VALUES
+
+# 12 x 64 material plus piece-square values, negative for black pieces
+PIECE_SQUARE_TABLE = np.array(PIECE_SQUARE_VALUES, dtype=np.int32)
+DEFAULT_CHUNK_SIZE = 65536  # positions packed at a time by evaluate_positions, about 50MB of planes
+
+# lookup tables from the two characters of a board square to its plane, -1 for "--"
+_KIND_OF = np.full(256, -1, dtype=np.int8)
+for _kind, _letter in enumerate('pNBRQK'):
+    _KIND_OF[ord(_letter)] = _kind
+_COLOUR_OFFSET = np.full(256, -1, dtype=np.int8)
+_COLOUR_OFFSET[ord('w')] = 0
+_COLOUR_OFFSET[ord('b')] = 6
+
+
+# packs a sequence of 8x8 GameState.board lists into an (N, 12, 64) uint8 array of piece planes.
+# Each board is joined into one 128 character string so the per-square work happens in numpy
+def pack_boards(boards):
+    text = "".join("".join(map("".join, board)) for board in boards).encode('ascii')
+    chars = np.frombuffer(text, dtype=np.uint8).reshape(-1, 64, 2)
+    colour = _COLOUR_OFFSET[chars[:, :, 0]]
+    indices = np.where(colour >= 0, colour + _KIND_OF[chars[:, :, 1]], -1)
+    return planes_from_indices(indices)
+
+
+# (N, 64) plane indices (-1 for empty) -> (N, 12, 64) planes
+def planes_from_indices(indices):
+    count = indices.shape[0]
+    planes = np.zeros((count, 12, 64), dtype=np.uint8)
+    position, square = np.nonzero(indices >= 0)
+    planes[position, indices[position, square], square] = 1
+    return planes
+
+
+# packs GameStates straight from their bitboards, skipping the board strings
+def pack_game_states(game_states):
+    bitboards = np.array([gs.bitboards for gs in game_states], dtype=np.uint64).reshape(-1, 12)
+    bits = np.unpackbits(bitboards.astype('<u8').view(np.uint8), bitorder='little')
+    return bits.reshape(len(bitboards), 12, 64)
+
+
+# scores of packed planes in centipawns from white's point of view, one int32 per position
+def evaluate_planes(planes):
+    return np.einsum('npq,pq->n', planes, PIECE_SQUARE_TABLE, dtype=np.int32)
+
+
+# scores boards or GameStates (any iterable, consumed chunk_size at a time so memory stays bounded)
+def evaluate_positions(positions, chunk_size=DEFAULT_CHUNK_SIZE):
+    results = []
+    chunk = []
+    for position in positions:
+        chunk.append(position)
+        if len(chunk) == chunk_size:
+            results.append(_evaluate_chunk(chunk))
+            chunk = []
+    if chunk:
+        results.append(_evaluate_chunk(chunk))
+    if not results:
+        return np.zeros(0, dtype=np.int32)
+    return np.concatenate(results)
+
+
+def _evaluate_chunk(chunk):
+    if hasattr(chunk[0], 'bitboards'):
+        return evaluate_planes(pack_game_states(chunk))
+    return evaluate_planes(pack_boards(chunk))
@@ -0,0 +1,232 @@
+# Bitboard tables and attack lookups used by the move generator in ChessEngine.
+# Squares are numbered row * 8 + col, the same row/col layout as GameState.board,
+# so square 0 is a8 and square 63 is h1. Bit n of a bitboard is square n.
+
+FULL = (1 << 64) - 1
+
+# the twelve piece sets, in the order GameState.bitboards stores them
+PIECES = ['wp', 'wN', 'wB', 'wR', 'wQ', 'wK', 'bp', 'bN', 'bB', 'bR', 'bQ', 'bK']
+PIECE_INDEX = {piece: i for i, piece in enumerate(PIECES)}
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = 0, 1, 2, 3, 4, 5
+
+# castling right bits
+WHITE_KING_SIDE, WHITE_QUEEN_SIDE, BLACK_KING_SIDE, BLACK_QUEEN_SIDE = 1, 2, 4, 8
+ALL_CASTLING = 15
+
+# A move code packs a move into 24 bits so move lists can be plain ints or an array('I'):
+#   bits 0-5 start square | 6-11 end square | 12-15 flag | 16-19 piece moved | 20-23 piece captured + 1 (0 = none)
+FLAG_NONE = 0
+FLAG_DOUBLE_PUSH = 1
+FLAG_ENPASSANT = 2
+FLAG_CASTLE = 3
+FLAG_PROMOTION = 4  # 4 + index into PROMOTION_PIECES
+PROMOTION_PIECES = ['Q', 'R', 'B', 'N']
+PIECE_SHIFT = 16
+CAPTURE_SHIFT = 20
+# capture bits for whatever stands on a target square, "--" adds nothing
+CAPTURE_BITS = {piece: (i + 1) << CAPTURE_SHIFT for i, piece in enumerate(PIECES)}
+CAPTURE_BITS["--"] = 0
+
+ROW_MASKS = [0xFF << (8 * row) for row in range(8)]
+COL_MASKS = [0x0101010101010101 << col for col in range(8)]
+
+ROOK_DIRECTIONS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+BISHOP_DIRECTIONS = ((-1, -1), (1, 1), (-1, 1), (1, -1))
+KNIGHT_OFFSETS = ((2, -1), (2, 1), (-2, 1), (-2, -1), (1, 2), (-1, 2), (1, -2), (-1, -2))
+KING_OFFSETS = ((-1, -1), (1, 1), (-1, 1), (1, -1), (-1, 0), (0, -1), (1, 0), (0, 1))
+
+
+def square(row, col):
+    return row * 8 + col
+
+
+def iter_bits(bb):
+    # yields the square of every set bit, lowest square first
+    while bb:
+        b = bb & -bb
+        yield b.bit_length() - 1
+        bb ^= b
+
+
+def _leaper_attacks(offsets):
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        bb = 0
+        for d in offsets:
+            end_row = row + d[0]
+            end_col = col + d[1]
+            if 0 <= end_row < 8 and 0 <= end_col < 8:
+                bb |= 1 << square(end_row, end_col)
+        table.append(bb)
+    return table
+
+
+KNIGHT_ATTACKS = _leaper_attacks(KNIGHT_OFFSETS)
+KING_ATTACKS = _leaper_attacks(KING_OFFSETS)
+# PAWN_ATTACKS[colour][sq] are the squares a pawn of that colour on sq attacks,
+# white pawns move towards row 0
+PAWN_ATTACKS = [_leaper_attacks(((-1, -1), (-1, 1))), _leaper_attacks(((1, -1), (1, 1)))]
+
+
+def _ray(sq, d):
+    # list of squares walked from sq in direction d, nearest first
+    row, col = divmod(sq, 8)
+    squares = []
+    for i in range(1, 8):
+        end_row = row + d[0] * i
+        end_col = col + d[1] * i
+        if not (0 <= end_row < 8 and 0 <= end_col < 8):
+            break
+        squares.append(square(end_row, end_col))
+    return squares
+
+
+def _slider_table(directions):
+    # For every square build a dict mapping each relevant blocker subset to the
+    # attack set, so a slider lookup is a single mask and dict index at runtime.
+    # The edge square of each ray never changes the result, so it is left out
+    # of the mask which keeps the tables at 4096 entries per rook square at most.
+    masks = []
+    tables = []
+    for sq in range(64):
+        # per direction: every blocker subset of that ray with the attacks it leaves
+        per_direction = []
+        mask = 0
+        for d in directions:
+            ray = _ray(sq, d)
+            inner = ray[:-1]
+            for s in inner:
+                mask |= 1 << s
+            options = []
+            for subset in range(1 << len(inner)):
+                blockers = 0
+                attacks = 0
+                for i, s in enumerate(inner):
+                    if subset >> i & 1:
+                        blockers |= 1 << s
+                for s in ray:
+                    attacks |= 1 << s
+                    if blockers >> s & 1:
+                        break
+                options.append((blockers, attacks))
+            per_direction.append(options)
+        partial = [(0, 0)]
+        for options in per_direction:
+            partial = [(b0 | b1, a0 | a1) for b0, a0 in partial for b1, a1 in options]
+        table = dict(partial)
+        masks.append(mask)
+        tables.append(table)
+    return masks, tables
+
+
+ROOK_MASKS, ROOK_TABLES = _slider_table(ROOK_DIRECTIONS)
+BISHOP_MASKS, BISHOP_TABLES = _slider_table(BISHOP_DIRECTIONS)
+
+
+def rook_attacks(sq, occupied):
+    return ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+
+
+def queen_attacks(sq, occupied):
+    return ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]] | BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+
+
+def _line_tables():
+    # BETWEEN[a][b] holds the squares strictly between two aligned squares,
+    # LINE[a][b] the whole board line through both of them (0 if not aligned)
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        for d in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            ray = _ray(sq, d)
+            full = 1 << sq
+            for s in ray + _ray(sq, (-d[0], -d[1])):
+                full |= 1 << s
+            path = 0
+            for s in ray:
+                between[sq][s] = path
+                line[sq][s] = full
+                path |= 1 << s
+    return between, line
+
+
+BETWEEN, LINE = _line_tables()
+
+# castling rights that survive a move touching the square (king or rook moved/captured)
+CASTLING_MASKS = [ALL_CASTLING] * 64
+CASTLING_MASKS[square(7, 4)] &= ~(WHITE_KING_SIDE | WHITE_QUEEN_SIDE)
+CASTLING_MASKS[square(7, 7)] &= ~WHITE_KING_SIDE
+CASTLING_MASKS[square(7, 0)] &= ~WHITE_QUEEN_SIDE
+CASTLING_MASKS[square(0, 4)] &= ~(BLACK_KING_SIDE | BLACK_QUEEN_SIDE)
+CASTLING_MASKS[square(0, 7)] &= ~BLACK_KING_SIDE
+CASTLING_MASKS[square(0, 0)] &= ~BLACK_QUEEN_SIDE
+
+
+def attackers_to(bitboards, sq, occupied, colour):
+    # bitboard of the pieces of colour that attack sq given the occupancy
+    base = 6 * colour
+    return ((PAWN_ATTACKS[1 - colour][sq] & bitboards[base + PAWN]) |
+            (KNIGHT_ATTACKS[sq] & bitboards[base + KNIGHT]) |
+            (KING_ATTACKS[sq] & bitboards[base + KING]) |
+            (BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]] & (bitboards[base + BISHOP] | bitboards[base + QUEEN])) |
+            (ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]] & (bitboards[base + ROOK] | bitboards[base + QUEEN])))
+
+
+# every square the pieces of colour attack (or defend) given the occupancy
+def attack_map(bitboards, colour, occupied):
+    base = 6 * colour
+    pawns = bitboards[base + PAWN]
+    if colour == WHITE:
+        attacks = ((pawns & ~COL_MASKS[0]) >> 9) | ((pawns & ~COL_MASKS[7]) >> 7)
+    else:
+        attacks = (((pawns & ~COL_MASKS[0]) << 7) | ((pawns & ~COL_MASKS[7]) << 9)) & FULL
+    attacks |= KING_ATTACKS[bitboards[base + KING].bit_length() - 1] if bitboards[base + KING] else 0
+    knights = bitboards[base + KNIGHT]
+    while knights:
+        b = knights & -knights
+        knights ^= b
+        attacks |= KNIGHT_ATTACKS[b.bit_length() - 1]
+    queens = bitboards[base + QUEEN]
+    sliders = bitboards[base + BISHOP] | queens
+    while sliders:
+        b = sliders & -sliders
+        sliders ^= b
+        sq = b.bit_length() - 1
+        attacks |= BISHOP_TABLES[sq][occupied & BISHOP_MASKS[sq]]
+    sliders = bitboards[base + ROOK] | queens
+    while sliders:
+        b = sliders & -sliders
+        sliders ^= b
+        sq = b.bit_length() - 1
+        attacks |= ROOK_TABLES[sq][occupied & ROOK_MASKS[sq]]
+    return attacks
+
+
+# captures, en passant and promotions: the capture stage of the move generator
+def is_tactical_code(code):
+    return code >> CAPTURE_SHIFT != 0 or (code >> 12 & 15) >= FLAG_PROMOTION
+
+
+def square_name(sq):
+    return "abcdefgh"[sq & 7] + str(8 - (sq >> 3))
+
+
+# long algebraic (UCI) notation of a move code, e.g. e2e4 or e7e8q
+def code_to_uci(code):
+    notation = square_name(code & 63) + square_name(code >> 6 & 63)
+    flag = code >> 12 & 15
+    if flag >= FLAG_PROMOTION:
+        notation += PROMOTION_PIECES[flag - FLAG_PROMOTION].lower()
+    return notation
+
+
+def board_to_bitboards(board):
+    bitboards = [0] * 12
+    for row in range(8):
+        for col in range(8):
+            piece = board[row][col]
+            if piece != "--":
+                bitboards[PIECE_INDEX[piece]] |= 1 << square(row, col)
+    return bitboards
@@ -0,0 +1,165 @@
+# Opening book in the Polyglot file layout: 16 byte big-endian entries of (position key 64, move 16,
+# weight 16, learn 32) sorted by key, several entries per position for the different book moves. Moves
+# use the Polyglot encoding (to file, to row, from file, from row, promotion piece in 3 bits each, rows
+# counted from rank 1, castling written as the king taking its own rook). The keys are our own
+# GameState.zobrist_key rather than Polyglot's random numbers, so books are built with this tool.
+#
+# Lookups binary search the memory-mapped file, nothing is loaded into memory.
+#
+#   python ChessBook.py build games.pgn book.bin --max-ply 20
+#   python ChessBook.py probe book.bin --fen "<fen>"
+
+import argparse
+import mmap
+import random
+import struct
+import sys
+
+import ChessEngine
+import ChessPGN
+
+ENTRY = struct.Struct('>QHHI')
+ENTRY_SIZE = ENTRY.size  # 16
+KEY = struct.Struct('>Q')
+MAX_WEIGHT = 0xFFFF
+POLYGLOT_PROMOTIONS = {'N': 1, 'B': 2, 'R': 3, 'Q': 4}
+
+
+# Polyglot code of a Move
+def encode_move(move):
+    end_col = move.end_col
+    if move.is_castle_move:
+        end_col = 7 if move.end_col == 6 else 0
+    code = end_col | (7 - move.end_row) << 3 | move.start_col << 6 | (7 - move.start_row) << 9
+    if move.is_pawn_promotion:
+        code |= POLYGLOT_PROMOTIONS[move.promotion_choice] << 12
+    return code
+
+
+# the legal Move of a Polyglot code in the position, None if it isn't legal there
+def decode_move(gs, code, valid_moves=None):
+    if valid_moves is None:
+        valid_moves = gs.get_valid_moves()
+    for move in valid_moves:
+        if encode_move(move) == code:
+            return move
+    return None
+
+
+class OpeningBook:
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty book
+            self.map = b""
+        self.count = len(self.map) // ENTRY_SIZE
+
+    # (move code, weight) of every book entry of a zobrist key, from the file's sorted order
+    def entries(self, key):
+        low, high = 0, self.count
+        while low < high:  # first entry with a key >= key
+            middle = (low + high) // 2
+            if KEY.unpack_from(self.map, middle * ENTRY_SIZE)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        found = []
+        for i in range(low, self.count):
+            entry_key, code, weight, _ = ENTRY.unpack_from(self.map, i * ENTRY_SIZE)
+            if entry_key != key:
+                break
+            found.append((code, weight))
+        return found
+
+    # book moves of the position as (Move, weight), entries that aren't legal moves are dropped
+    def moves(self, gs):
+        entries = self.entries(gs.zobrist_key)
+        if not entries:
+            return []
+        valid_moves = gs.get_valid_moves()
+        result = []
+        for code, weight in entries:
+            move = decode_move(gs, code, valid_moves)
+            if move is not None:
+                result.append((move, weight))
+        return result
+
+    # a book move picked at random in proportion to the weights, None when out of book
+    def choose(self, gs, rng=random):
+        moves = [(move, weight) for move, weight in self.moves(gs) if weight > 0]
+        if not moves:
+            return None
+        return rng.choices([move for move, _ in moves], [weight for _, weight in moves])[0]
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# builds a book from PGN files: every move in the first max_ply plies of each game scores 2 for a win of
+# the side that played it, 1 for a draw and 0 for a loss or unknown result. Moves played fewer than
+# min_games times are left out. Returns the number of entries written
+def build_book(pgn_paths, out_path, max_ply=20, min_games=1):
+    stats = {}  # (key, move code) -> [games, score]
+    for path in pgn_paths:
+        for headers, sans, result in ChessPGN.read_games(path):
+            gs = ChessEngine.GameState(headers.get('FEN'))
+            for san in sans[:max_ply]:
+                try:
+                    move = ChessPGN.move_from_san(gs, san)
+                except ValueError:
+                    break
+                entry = stats.setdefault((gs.zobrist_key, encode_move(move)), [0, 0])
+                entry[0] += 1
+                if result == '1/2-1/2':
+                    entry[1] += 1
+                elif result == ('1-0' if gs.white_to_move else '0-1'):
+                    entry[1] += 2
+                gs.make_move(move)
+
+    entries = [(key, code, score) for (key, code), (games, score) in stats.items() if games >= min_games and score]
+    top = max((score for _, _, score in entries), default=1)
+    scale = min(1.0, MAX_WEIGHT / top)
+    entries.sort(key=lambda entry: (entry[0], -entry[2]))
+    with open(out_path, 'wb') as f:
+        for key, code, score in entries:
+            f.write(ENTRY.pack(key, code, max(1, int(score * scale)), 0))
+    return len(entries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or look into an opening book")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build a book from PGN files")
+    build.add_argument("pgn", nargs="+", help="PGN files")
+    build.add_argument("book", help="book file to write")
+    build.add_argument("--max-ply", type=int, default=20, help="plies of each game that go into the book")
+    build.add_argument("--min-games", type=int, default=1, help="leave out moves played in fewer games")
+    probe = commands.add_parser("probe", help="list the book moves of a position")
+    probe.add_argument("book")
+    probe.add_argument("--fen", default=None, help="position, defaults to the start position")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        print("%d entries" % build_book(args.pgn, args.book, args.max_ply, args.min_games))
+        return 0
+    gs = ChessEngine.GameState(args.fen)
+    with OpeningBook(args.book) as book:
+        moves = book.moves(gs)
+        total = sum(weight for _, weight in moves) or 1
+        for move, weight in sorted(moves, key=lambda item: -item[1]):
+            print("%-6s %-6s weight %5d  %5.1f%%" % (move.get_uci_notation(), ChessPGN.to_san(gs, move), weight,
+                                                    100 * weight / total))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# Streaming reader for EPD and FEN files, one position per line. The file is memory-mapped and lines are
+# parsed one at a time as the generator is advanced, so a dump of any size is read with constant memory
+# and the operating system pages it in as needed. Lines are either plain FEN or EPD: the four position
+# fields, optionally the two move clocks, then operations such as  bm Nf3; id "WAC.001";  or the perft
+# suite style  ;D1 20 ;D2 400
+#
+#   for fen, operations in read_positions("wac.epd"): ...
+#   for gs, operations in read_game_states("dump.fen"): ...
+
+import mmap
+import re
+
+import ChessEngine
+
+_CLOCKS = re.compile(r'(\d+)\s+(\d+)(?=\s|;|$)')
+
+
+# yields (fen, operations) for every position in the file, blank lines and lines starting with # skipped.
+# fen always has six fields (missing clocks are filled in as 0 1), operations maps opcode to its operand
+# text with quotes removed
+def read_positions(path):
+    for line in read_lines(path):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield parse_epd(line)
+
+
+# yields (GameState, operations). With reuse=True one GameState is loaded with each position in turn,
+# which is faster but means a yielded GameState is only valid until the next one is read
+def read_game_states(path, reuse=False):
+    gs = None
+    for fen, operations in read_positions(path):
+        if gs is None or not reuse:
+            gs = ChessEngine.GameState(fen)
+        else:
+            gs.load_fen(fen)
+        yield gs, operations
+
+
+# the lines of a file as str, read through a memory map. Bytes that aren't UTF-8 (PGN files are often
+# Latin-1) are replaced rather than stopping the read
+def read_lines(path):
+    with open(path, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            return
+        with mapped:
+            for line in iter(mapped.readline, b""):
+                yield line.decode('utf-8', errors='replace')
+
+
+# splits one FEN/EPD line into (fen, operations)
+def parse_epd(line):
+    fields = line.split(None, 4)
+    if len(fields) < 4:
+        raise ValueError("EPD needs at least 4 fields: " + line)
+    rest = fields[4] if len(fields) > 4 else ""
+    clocks = _CLOCKS.match(rest)
+    if clocks:
+        fen = " ".join(fields[:4] + list(clocks.groups()))
+        rest = rest[clocks.end():]
+    else:
+        fen = " ".join(fields[:4]) + " 0 1"
+
+    operations = {}
+    for text in split_operations(rest):
+        opcode, _, operand = text.strip().partition(' ')
+        if opcode:
+            operations[opcode] = operand.strip().strip('"')
+    return fen, operations
+
+
+# splits EPD operations on the semicolons that are not inside quotes
+def split_operations(text):
+    if '"' not in text:
+        return text.split(';')
+    parts = []
+    start = 0
+    quoted = False
+    for i, ch in enumerate(text):
+        if ch == '"':
+            quoted = not quoted
+        elif ch == ';' and not quoted:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
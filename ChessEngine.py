@@ -1,8 +1,30 @@
 # Responsible for storing all info about current state of chess game, it will also
 # be responsible for determining the valid moves
 
+from array import array
+
+from ChessBitboard import (PIECE_INDEX, WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, FULL,
+                           ALL_CASTLING, WHITE_KING_SIDE, WHITE_QUEEN_SIDE, BLACK_KING_SIDE, BLACK_QUEEN_SIDE,
+                           FLAG_DOUBLE_PUSH, FLAG_ENPASSANT, FLAG_CASTLE, FLAG_PROMOTION, PROMOTION_PIECES,
+                           KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, ROOK_TABLES, ROOK_MASKS, BISHOP_TABLES,
+                           BISHOP_MASKS, BETWEEN, LINE, CASTLING_MASKS, ROW_MASKS, COL_MASKS,
+                           PIECES, PIECE_SHIFT, CAPTURE_SHIFT, CAPTURE_BITS, attackers_to, attack_map,
+                           board_to_bitboards)
+from ChessZobrist import PIECE_KEYS, SIDE_KEY, CASTLING_KEYS, ENPASSANT_KEYS, compute_key
+
+# modes of GameState.generate_move_codes
+LIST_MOVES, COUNT_MOVES, ANY_MOVE = 0, 1, 2
+# castling right, king and its square, rook and its square: a right only stands with both at home
+CASTLING_HOMES = ((WHITE_KING_SIDE, 'wK', 60, 'wR', 63), (WHITE_QUEEN_SIDE, 'wK', 60, 'wR', 56),
+                  (BLACK_KING_SIDE, 'bK', 4, 'bR', 7), (BLACK_QUEEN_SIDE, 'bK', 4, 'bR', 0))
+MOVE_CACHE_SIZE = 1 << 16  # Move objects Move.from_code keeps for reuse, see _move_cache
+
+
 class GameState:
-    def __init__(self):
+    # when set, make_move/undo_move check the incremental zobrist key against a full recomputation
+    debug_zobrist = False
+
+    def __init__(self, fen=None):
         # board is 8x8 2d list, each element of the list has 2 characters,
         # The first character represents colour of the piece and second character
         # represent type of piece and "--" represents an empty space
@@ -23,16 +45,209 @@ class GameState:
         self.move_log = []
         self.white_king_location = (7, 4)
         self.black_king_location = (0, 4)
-        self.in_check = False
+        self.in_check = False  # set by the move generator, is_in_check() works it out from the bitboards
+        self.checkmate = False
+        self.stalemate = False
         self.pins = []
         self.checks = []
 
+        # bitboard backend, kept in sync with board by make_move/undo_move
+        self.bitboards = board_to_bitboards(self.board)  # one 64-bit set per piece, see ChessBitboard.PIECES
+        self.occupancy = [0, 0]  # all white pieces, all black pieces
+        self.castling_rights = ALL_CASTLING
+        self.enpassant_square = -1  # square a pawn can capture onto en passant, -1 if none or no pawn can
+        self.halfmove_clock = 0  # moves since the last capture or pawn move, for the fifty move rule
+        self.fullmove_number = 1  # starts at 1 and goes up after each black move, as in FEN
+        self.state_log = []  # (castling_rights, enpassant_square, halfmove_clock) before each move, for undo
+        self.update_occupancy()
+        self.zobrist_key = compute_key(self)  # 64-bit position hash, updated incrementally by make/undo
+        self.attack_maps = [0, 0]  # squares attacked by white and by black, see get_attack_map
+        self.attack_maps_key = None  # zobrist key of the position attack_maps was computed for
+        if fen is not None:
+            self.load_fen(fen)
+
+    def update_occupancy(self):
+        self.occupancy[WHITE] = 0
+        self.occupancy[BLACK] = 0
+        for i in range(6):
+            self.occupancy[WHITE] |= self.bitboards[i]
+            self.occupancy[BLACK] |= self.bitboards[i + 6]
+
+    # set up the position described by a FEN string. The move clocks may be left out (as in EPD), any
+    # fields after them are ignored
+    def load_fen(self, fen):
+        fields = fen.split()
+        if len(fields) < 4:
+            raise ValueError("FEN needs at least 4 fields: " + fen)
+        rows = fields[0].split('/')
+        if len(rows) != 8:
+            raise ValueError("FEN board needs 8 rows: " + fen)
+        board = []
+        for row_text in rows:
+            row = []
+            for ch in row_text:
+                if ch.isdigit():
+                    row.extend(["--"] * int(ch))
+                elif ch.lower() in "pnbrqk":
+                    piece = ch.upper() if ch.lower() != 'p' else 'p'
+                    row.append(('w' if ch.isupper() else 'b') + piece)
+                else:
+                    raise ValueError("bad FEN piece " + repr(ch) + ": " + fen)
+            if len(row) != 8:
+                raise ValueError("FEN row doesn't have 8 squares: " + fen)
+            board.append(row)
+        if fields[1] not in ('w', 'b'):
+            raise ValueError("bad FEN side to move: " + fen)
+
+        castling_rights = 0
+        for ch, right in (('K', WHITE_KING_SIDE), ('Q', WHITE_QUEEN_SIDE), ('k', BLACK_KING_SIDE),
+                          ('q', BLACK_QUEEN_SIDE)):
+            if ch in fields[2]:
+                castling_rights |= right
+        if fields[3] == '-':
+            enpassant_square = -1
+        elif len(fields[3]) == 2 and fields[3][0] in Move.files_to_cols and fields[3][1] in '36':
+            enpassant_square = Move.ranks_to_rows[fields[3][1]] * 8 + Move.files_to_cols[fields[3][0]]
+        else:
+            raise ValueError("bad FEN en passant square: " + fen)
+        if len(fields) >= 6 and fields[4].isdigit() and fields[5].isdigit():
+            halfmove_clock = int(fields[4])
+            fullmove_number = max(1, int(fields[5]))
+        else:
+            halfmove_clock = 0
+            fullmove_number = 1
+        self.reset_position(board_to_bitboards(board), board, fields[1] == 'w', castling_rights, enpassant_square,
+                            halfmove_clock, fullmove_number)
+
+    # set up a position from its 12 piece bitboards (ordered as ChessBitboard.PIECES), side to move,
+    # castling rights bits and en passant square (-1 for none)
+    def load_bitboards(self, bitboards, white_to_move, castling_rights, enpassant_square,
+                       halfmove_clock=0, fullmove_number=1):
+        board = [["--"] * 8 for _ in range(8)]
+        for index, bb in enumerate(bitboards):
+            piece = PIECES[index]
+            while bb:
+                b = bb & -bb
+                bb ^= b
+                sq = b.bit_length() - 1
+                board[sq >> 3][sq & 7] = piece
+        self.reset_position(list(bitboards), board, white_to_move, castling_rights, enpassant_square,
+                            halfmove_clock, fullmove_number)
+
+    # common end of load_fen and load_bitboards: checks the position, then installs it and clears
+    # everything derived from the previous one. Nothing changes when it raises ValueError
+    def reset_position(self, bitboards, board, white_to_move, castling_rights, enpassant_square,
+                       halfmove_clock, fullmove_number):
+        for piece in ('wK', 'bK'):
+            if bitboards[PIECE_INDEX[piece]].bit_count() != 1:
+                raise ValueError("position needs exactly one king per side")
+        for right, king, king_sq, rook, rook_sq in CASTLING_HOMES:
+            if not (bitboards[PIECE_INDEX[king]] >> king_sq & 1 and bitboards[PIECE_INDEX[rook]] >> rook_sq & 1):
+                castling_rights &= ~right  # the king or rook has left home, the right is gone
+        us = WHITE if white_to_move else BLACK
+        if enpassant_square >= 0 and not PAWN_ATTACKS[1 - us][enpassant_square] & bitboards[6 * us + PAWN]:
+            enpassant_square = -1  # no pawn can take en passant, as make_move leaves it
+        self.board = board
+        self.bitboards = bitboards
+        self.white_to_move = white_to_move
+        self.castling_rights = castling_rights
+        self.enpassant_square = enpassant_square
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = fullmove_number
+        self.move_log = []
+        self.state_log = []
+        self.checkmate = False
+        self.stalemate = False
+        self.update_occupancy()
+        self.white_king_location = divmod(self.bitboards[PIECE_INDEX['wK']].bit_length() - 1, 8)
+        self.black_king_location = divmod(self.bitboards[PIECE_INDEX['bK']].bit_length() - 1, 8)
+        self.zobrist_key = compute_key(self)
+
+    # FEN string of the current position
+    def get_fen(self):
+        rows = []
+        for row in self.board:
+            text = ""
+            empty = 0
+            for piece in row:
+                if piece == "--":
+                    empty += 1
+                    continue
+                if empty:
+                    text += str(empty)
+                    empty = 0
+                text += piece[1].upper() if piece[0] == 'w' else piece[1].lower()
+            if empty:
+                text += str(empty)
+            rows.append(text)
+        castling = "".join(ch for ch, right in (('K', WHITE_KING_SIDE), ('Q', WHITE_QUEEN_SIDE),
+                                                ('k', BLACK_KING_SIDE), ('q', BLACK_QUEEN_SIDE))
+                           if self.castling_rights & right) or "-"
+        if self.enpassant_square == -1:
+            enpassant = "-"
+        else:
+            row, col = divmod(self.enpassant_square, 8)
+            enpassant = Move.cols_to_files[col] + Move.row_to_ranks[row]
+        return "%s %s %s %s %d %d" % ("/".join(rows), 'w' if self.white_to_move else 'b', castling, enpassant,
+                                      self.halfmove_clock, self.fullmove_number)
+
     # Takes a move as a parameter and execute it
     def make_move(self, move):
         self.board[move.start_row][move.start_col] = "--"
         self.board[move.end_row][move.end_col] = move.piece_moved
         self.move_log.append(move)  # log the move so we can undo it later
+        self.state_log.append((self.castling_rights, self.enpassant_square, self.halfmove_clock))
         self.white_to_move = not self.white_to_move  # swap players
+        if move.piece_moved[1] == 'p' or move.piece_captured != "--":
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if self.white_to_move:  # black just moved
+            self.fullmove_number += 1
+
+        start = move.start_row * 8 + move.start_col
+        end = move.end_row * 8 + move.end_col
+        colour = WHITE if move.piece_moved[0] == 'w' else BLACK
+        moved = PIECE_INDEX[move.piece_moved]
+        from_to = (1 << start) | (1 << end)
+        self.bitboards[moved] ^= from_to
+        self.occupancy[colour] ^= from_to
+        key = self.zobrist_key ^ PIECE_KEYS[moved][start] ^ PIECE_KEYS[moved][end] ^ SIDE_KEY
+
+        if move.is_enpassant_move:  # captured pawn is beside the start square, not on the end square
+            self.board[move.start_row][move.end_col] = "--"
+            captured_sq = move.start_row * 8 + move.end_col
+            captured = PIECE_INDEX[move.piece_captured]
+            self.bitboards[captured] ^= 1 << captured_sq
+            self.occupancy[1 - colour] ^= 1 << captured_sq
+            key ^= PIECE_KEYS[captured][captured_sq]
+        elif move.piece_captured != "--":
+            captured = PIECE_INDEX[move.piece_captured]
+            self.bitboards[captured] ^= 1 << end
+            self.occupancy[1 - colour] ^= 1 << end
+            key ^= PIECE_KEYS[captured][end]
+
+        if move.is_pawn_promotion:
+            promoted = move.piece_moved[0] + move.promotion_choice
+            self.board[move.end_row][move.end_col] = promoted
+            self.bitboards[moved] ^= 1 << end
+            self.bitboards[PIECE_INDEX[promoted]] ^= 1 << end
+            key ^= PIECE_KEYS[moved][end] ^ PIECE_KEYS[PIECE_INDEX[promoted]][end]
+
+        if move.is_castle_move:
+            key ^= self.move_castling_rook(move)
+
+        # a pawn that moved two squares can be taken en passant on the square it skipped. The square is
+        # only kept when an enemy pawn is there to take it, so the key of a position doesn't depend on
+        # how it was reached (books and hash tables find it either way)
+        key ^= ENPASSANT_KEYS[self.enpassant_square] ^ CASTLING_KEYS[self.castling_rights]
+        self.enpassant_square = -1
+        if move.piece_moved[1] == 'p' and abs(move.start_row - move.end_row) == 2:
+            skipped = ((move.start_row + move.end_row) // 2) * 8 + move.start_col
+            if PAWN_ATTACKS[colour][skipped] & self.bitboards[6 * (1 - colour) + PAWN]:
+                self.enpassant_square = skipped
+        self.castling_rights &= CASTLING_MASKS[start] & CASTLING_MASKS[end]
+        self.zobrist_key = key ^ ENPASSANT_KEYS[self.enpassant_square] ^ CASTLING_KEYS[self.castling_rights]
 
         # update king's position
         if move.piece_moved == 'wK':
@@ -40,19 +255,91 @@ class GameState:
         elif move.piece_moved == 'bK':
             self.black_king_location = (move.end_row, move.end_col)
 
+        if self.debug_zobrist:
+            self.verify_zobrist_key()
+
     # will undo the last move
     def undo_move(self):
         if len(self.move_log) != 0:
             move = self.move_log.pop()
+            key = (self.zobrist_key ^ SIDE_KEY ^
+                   ENPASSANT_KEYS[self.enpassant_square] ^ CASTLING_KEYS[self.castling_rights])
+            self.castling_rights, self.enpassant_square, self.halfmove_clock = self.state_log.pop()
+            key ^= ENPASSANT_KEYS[self.enpassant_square] ^ CASTLING_KEYS[self.castling_rights]
             self.board[move.start_row][move.start_col] = move.piece_moved
             self.board[move.end_row][move.end_col] = move.piece_captured
             self.white_to_move = not self.white_to_move
+            if not self.white_to_move:
+                self.fullmove_number -= 1
+
+            start = move.start_row * 8 + move.start_col
+            end = move.end_row * 8 + move.end_col
+            colour = WHITE if move.piece_moved[0] == 'w' else BLACK
+            moved = PIECE_INDEX[move.piece_moved]
+            if move.is_pawn_promotion:
+                promoted = PIECE_INDEX[move.piece_moved[0] + move.promotion_choice]
+                self.bitboards[promoted] ^= 1 << end
+                self.bitboards[moved] ^= 1 << end
+                key ^= PIECE_KEYS[promoted][end] ^ PIECE_KEYS[moved][end]
+
+            from_to = (1 << start) | (1 << end)
+            self.bitboards[moved] ^= from_to
+            self.occupancy[colour] ^= from_to
+            key ^= PIECE_KEYS[moved][start] ^ PIECE_KEYS[moved][end]
+
+            if move.is_enpassant_move:
+                self.board[move.end_row][move.end_col] = "--"
+                self.board[move.start_row][move.end_col] = move.piece_captured
+                captured_sq = move.start_row * 8 + move.end_col
+                captured = PIECE_INDEX[move.piece_captured]
+                self.bitboards[captured] ^= 1 << captured_sq
+                self.occupancy[1 - colour] ^= 1 << captured_sq
+                key ^= PIECE_KEYS[captured][captured_sq]
+            elif move.piece_captured != "--":
+                captured = PIECE_INDEX[move.piece_captured]
+                self.bitboards[captured] ^= 1 << end
+                self.occupancy[1 - colour] ^= 1 << end
+                key ^= PIECE_KEYS[captured][end]
+
+            if move.is_castle_move:
+                key ^= self.move_castling_rook(move, undo=True)
+            self.zobrist_key = key
 
             # update king's position
             if move.piece_moved == 'wK':
-                self.white_king_location = (move.end_row, move.end_col)
+                self.white_king_location = (move.start_row, move.start_col)
             elif move.piece_moved == 'bK':
-                self.black_king_location = (move.end_row, move.end_col)
+                self.black_king_location = (move.start_row, move.start_col)
+
+            if self.debug_zobrist:
+                self.verify_zobrist_key()
+
+    # moves the rook of a castle move on the board and bitboards, or puts it back when undoing,
+    # returns the zobrist key change of the rook move
+    def move_castling_rook(self, move, undo=False):
+        row = move.end_row
+        if move.end_col - move.start_col == 2:  # king side
+            rook_from, rook_to = 7, 5
+        else:  # queen side
+            rook_from, rook_to = 0, 3
+        if undo:
+            rook_from, rook_to = rook_to, rook_from
+        rook = self.board[row][rook_from]
+        self.board[row][rook_to] = rook
+        self.board[row][rook_from] = "--"
+        rook_from = row * 8 + rook_from
+        rook_to = row * 8 + rook_to
+        index = PIECE_INDEX[rook]
+        self.bitboards[index] ^= (1 << rook_from) | (1 << rook_to)
+        self.occupancy[WHITE if rook[0] == 'w' else BLACK] ^= (1 << rook_from) | (1 << rook_to)
+        return PIECE_KEYS[index][rook_from] ^ PIECE_KEYS[index][rook_to]
+
+    # raises if the incrementally updated zobrist key disagrees with one computed from scratch
+    def verify_zobrist_key(self):
+        expected = compute_key(self)
+        if self.zobrist_key != expected:
+            raise RuntimeError("zobrist key %016x does not match recomputed key %016x after %s" % (
+                self.zobrist_key, expected, self.move_log[-1].get_uci_notation() if self.move_log else "setup"))
 
     # naive algorithm for getting valid move, by generating all our moves and for all our moves generate all opponent's move
     # then check if they attack you king and then deem it is as an invalid move if they do
@@ -63,53 +350,394 @@ class GameState:
         # for i in range(len(moves) - 1, -1, -1):
         #     self.make_move(moves[i])
         #     self.white_to_move = not self.white_to_move
-        #     if self.in_check():
+        #     if self.is_in_check():
         #         moves.remove(moves[i])
         #     self.white_to_move = not self.white_to_move
         #     self.undo_move()
         # return moves
         return self.get_all_possible_moves()
 
+    # legal moves for the side to move, generated from the bitboards. Moves already seen come from the
+    # from_code cache, so only new codes pay for building a Move
     def get_valid_moves(self):
-        moves = []
-        self.pins, self.in_check, self.checks = self.check_for_pins_and_checks()
-        if self.white_to_move:
-            king_row = self.white_king_location[0]
-            king_col = self.white_king_location[1]
+        cache = _move_cache
+        moves = [cache.get(code) or Move.from_code(code) for code in self.get_valid_move_codes()]
+        self.checkmate = self.in_check and len(moves) == 0
+        self.stalemate = not self.in_check and len(moves) == 0
+        return moves
+
+    # legal moves as an array of packed move codes, see ChessBitboard for the layout
+    def get_valid_move_array(self):
+        return array('I', self.get_valid_move_codes())
+
+    # legal moves as a list of packed move codes, see ChessBitboard for the layout.
+    # captures covers captures, en passant and promotions, quiets everything else
+    def get_valid_move_codes(self, captures=True, quiets=True):
+        return self.generate_move_codes(captures, quiets, LIST_MOVES)
+
+    # number of legal moves, counted from the target sets without building any moves
+    def count_legal_moves(self):
+        return self.generate_move_codes(True, True, COUNT_MOVES)
+
+    # stops at the first legal move found, enough to tell checkmate and stalemate apart from play on
+    def has_legal_move(self):
+        return self.generate_move_codes(True, True, ANY_MOVE) > 0
+
+    # is the side to move in check, without generating any moves
+    def is_in_check(self):
+        us = WHITE if self.white_to_move else BLACK
+        king_sq = self.bitboards[6 * us + KING].bit_length() - 1
+        return attackers_to(self.bitboards, king_sq, self.occupancy[WHITE] | self.occupancy[BLACK], 1 - us) != 0
+
+    # yields legal move codes in stages: the hash move if it is legal here, then captures, then quiet moves.
+    # The hash move is checked on its own by is_legal_code and a stage is only generated when the caller
+    # asks for its first move, so a cutoff on the hash move or a capture never pays for the quiet moves.
+    # capture_key/quiet_key sort a stage best first.
+    def generate_moves(self, hash_move=0, capture_key=None, quiet_key=None):
+        if hash_move and self.is_legal_code(hash_move):
+            yield hash_move
+        capture_codes = self.get_valid_move_codes(quiets=False)
+        if capture_key is not None:
+            capture_codes.sort(key=capture_key, reverse=True)
+        for code in capture_codes:
+            if code != hash_move:
+                yield code
+        quiet_codes = self.get_valid_move_codes(captures=False)
+        if quiet_key is not None:
+            quiet_codes.sort(key=quiet_key, reverse=True)
+        for code in quiet_codes:
+            if code != hash_move:
+                yield code
+
+    # is the move code one of the legal moves here, worked out for that move alone: the piece has to stand
+    # on the start square, the captured piece has to match the target, the piece has to reach the target
+    # and the own king can't be attacked once the move is made. True exactly for the codes
+    # get_valid_move_codes lists.
+    def is_legal_code(self, code):
+        bitboards = self.bitboards
+        us = WHITE if self.white_to_move else BLACK
+        them = 1 - us
+        piece = code >> PIECE_SHIFT & 15
+        kind = piece - 6 * us
+        start = code & 63
+        end = code >> 6 & 63
+        flag = code >> 12 & 15
+        if (not 0 <= kind <= KING or flag >= FLAG_PROMOTION + len(PROMOTION_PIECES) or
+                not bitboards[piece] >> start & 1):
+            return False
+        own = self.occupancy[us]
+        enemy = self.occupancy[them]
+        occupied = own | enemy
+        target = 1 << end
+        captured_sq = end
+        if flag == FLAG_ENPASSANT:
+            if kind != PAWN or end != self.enpassant_square or not PAWN_ATTACKS[us][start] & target:
+                return False
+            captured_sq = end + (8 if us == WHITE else -8)
+            captured_bits = (6 * them + PAWN + 1) << CAPTURE_SHIFT
         else:
-            king_row = self.black_king_location[0]
-            king_col = self.black_king_location[1]
-
-        if self.in_check:
-            if len(self.checks) == 1:  # only one check , either block the check or move the piece
-                moves = self.get_all_possible_moves()
-                # to block a check you must move a piece into one of the squares between the enemy piece and king
-                check = self.checks[0]  # check information
-                check_row = check[0]
-                check_col = check[1]
-                piece_checking = self.board[check_row][check_col]  # enemy piece causing the check
-                valid_squares = []  # squares that pieces can move to
-                # if the knight, must capture knight or move king other pieces can be blocked
-
-                if piece_checking[1] == 'N':
-                    valid_squares = [(check_row, check_col)]
+            captured_bits = CAPTURE_BITS[self.board[end >> 3][end & 7]]
+        if target & own or code >> CAPTURE_SHIFT != captured_bits >> CAPTURE_SHIFT:
+            return False
+
+        if kind == PAWN:
+            forward = -8 if us == WHITE else 8
+            if (flag >= FLAG_PROMOTION) != (end >> 3 == (0 if us == WHITE else 7)):
+                return False
+            if flag == FLAG_DOUBLE_PUSH:
+                reaches = (start >> 3 == (6 if us == WHITE else 1) and end == start + 2 * forward and
+                           not occupied & (target | 1 << (start + forward)))
+            elif flag == FLAG_ENPASSANT:
+                reaches = True
+            elif flag == FLAG_CASTLE:
+                reaches = False
+            else:
+                reaches = (PAWN_ATTACKS[us][start] & target & enemy or
+                           (end == start + forward and not occupied & target))
+        elif flag == FLAG_CASTLE:
+            # the right stands only while king and rook are at home, the squares between them have to be
+            # empty and the king can't castle out of, through or into check
+            if kind != KING or abs(end - start) != 2:
+                return False
+            for right, _, king_sq, _, rook_sq in CASTLING_HOMES:
+                if king_sq == start and (rook_sq > start) == (end > start):
+                    return (self.castling_rights & right != 0 and not BETWEEN[start][rook_sq] & occupied and
+                            not any(attackers_to(bitboards, sq, occupied, them)
+                                    for sq in (start, (start + end) // 2, end)))
+            return False
+        elif flag:
+            return False
+        elif kind == KNIGHT:
+            reaches = KNIGHT_ATTACKS[start] & target
+        elif kind == KING:
+            reaches = KING_ATTACKS[start] & target
+        else:
+            reaches = 0
+            if kind != ROOK:
+                reaches |= BISHOP_TABLES[start][occupied & BISHOP_MASKS[start]] & target
+            if kind != BISHOP:
+                reaches |= ROOK_TABLES[start][occupied & ROOK_MASKS[start]] & target
+        if not reaches:
+            return False
+
+        # king safety on the occupancy after the move, the captured piece no longer attacks anything
+        king_sq = end if kind == KING else bitboards[6 * us + KING].bit_length() - 1
+        after = (occupied ^ (1 << start) ^ (1 << captured_sq)) | target
+        return not attackers_to(bitboards, king_sq, after, them) & ~(1 << captured_sq)
+
+    # The legal move generator. With mode LIST_MOVES it returns the list of move codes, with COUNT_MOVES
+    # the number of moves (bulk counted with popcounts where it can) and with ANY_MOVE it returns as
+    # soon as it knows the count is above zero.
+    def generate_move_codes(self, captures, quiets, mode):
+        bitboards = self.bitboards
+        board = self.board
+        us = WHITE if self.white_to_move else BLACK
+        them = 1 - us
+        base = 6 * us
+        enemy_base = 6 * them
+        own = self.occupancy[us]
+        enemy = self.occupancy[them]
+        occupied = own | enemy
+        empty = FULL ^ occupied
+        not_own = FULL ^ own
+        king_sq = bitboards[base + KING].bit_length() - 1
+        checkers = attackers_to(bitboards, king_sq, occupied, them)
+        self.in_check = checkers != 0
+        listing = mode == LIST_MOVES
+        stop_early = mode == ANY_MOVE
+        count = 0
+        moves = []
+        append = moves.append
+        capture_bits = CAPTURE_BITS
+        stage_mask = (enemy if captures else 0) | (empty if quiets else 0)
+
+        # king moves, with the king lifted off the board so it can't hide behind itself from a slider
+        without_king = occupied ^ (1 << king_sq)
+        start_bits = king_sq | (base + KING) << PIECE_SHIFT
+        targets = KING_ATTACKS[king_sq] & not_own & stage_mask
+        while targets:
+            b = targets & -targets
+            targets ^= b
+            end = b.bit_length() - 1
+            if not attackers_to(bitboards, end, without_king, them):
+                if not listing:
+                    count += 1
+                    if stop_early:
+                        return count
                 else:
-                    for i in range(1, 8):
-                        valid_square = (king_row + check[2] * i, king_col + check[3] * i)  # check[2] and check[3] are directions of check
-                        valid_squares.append(valid_square)
-                        if valid_square[0] == check_row and valid_square[1] == check_col:  # once you get to piece and checks
-                            break
-                            # get rid of any moves that don't block or move the king
-                for i in range(len(moves) - 1, -1, -1):  # go through backwards when you are removing from a list when iterating
-                    if moves[i].piece_moved[1] != 'K':  # moves doesn't move king, so it must block or captures
-                        if not (moves[i].end_row, moves[i].end_col) in valid_squares:
-                            moves.remove(moves[i])
+                    append(start_bits | end << 6 | capture_bits[board[end >> 3][end & 7]])
+        if checkers & (checkers - 1):  # double check, only the king can move
+            return moves if listing else count
+
+        # squares a non king move has to land on: anywhere, or capture/block the single checker
+        if checkers:
+            checker_sq = checkers.bit_length() - 1
+            target_mask = checkers | BETWEEN[king_sq][checker_sq]
+        else:
+            target_mask = FULL
+
+        # enemy sliders that see the king through exactly one of our pieces pin that piece
+        enemy_rooks = bitboards[enemy_base + ROOK] | bitboards[enemy_base + QUEEN]
+        enemy_bishops = bitboards[enemy_base + BISHOP] | bitboards[enemy_base + QUEEN]
+        snipers = ((ROOK_TABLES[king_sq][enemy & ROOK_MASKS[king_sq]] & enemy_rooks) |
+                   (BISHOP_TABLES[king_sq][enemy & BISHOP_MASKS[king_sq]] & enemy_bishops))
+        pinned = 0
+        pin_lines = {}
+        while snipers:
+            b = snipers & -snipers
+            snipers ^= b
+            sniper_sq = b.bit_length() - 1
+            blockers = BETWEEN[king_sq][sniper_sq] & occupied
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pinned |= blockers
+                pin_lines[blockers.bit_length() - 1] = LINE[king_sq][sniper_sq]
+
+        move_mask = not_own & target_mask & stage_mask
+        knights = bitboards[base + KNIGHT] & ~pinned  # a pinned knight can never move
+        piece_bits = (base + KNIGHT) << PIECE_SHIFT
+        while knights:
+            b = knights & -knights
+            knights ^= b
+            start = b.bit_length() - 1
+            targets = KNIGHT_ATTACKS[start] & move_mask
+            if not listing:
+                count += targets.bit_count()
+                continue
+            start_bits = start | piece_bits
+            while targets:
+                t = targets & -targets
+                targets ^= t
+                end = t.bit_length() - 1
+                append(start_bits | end << 6 | capture_bits[board[end >> 3][end & 7]])
+
+        # queens are walked once as a bishop and once as a rook
+        queens = bitboards[base + QUEEN]
+        sliders = bitboards[base + BISHOP] | queens
+        while sliders:
+            b = sliders & -sliders
+            sliders ^= b
+            start = b.bit_length() - 1
+            targets = BISHOP_TABLES[start][occupied & BISHOP_MASKS[start]] & move_mask
+            if b & pinned:
+                targets &= pin_lines[start]
+            if not listing:
+                count += targets.bit_count()
+                continue
+            start_bits = start | (base + (QUEEN if b & queens else BISHOP)) << PIECE_SHIFT
+            while targets:
+                t = targets & -targets
+                targets ^= t
+                end = t.bit_length() - 1
+                append(start_bits | end << 6 | capture_bits[board[end >> 3][end & 7]])
+        sliders = bitboards[base + ROOK] | queens
+        while sliders:
+            b = sliders & -sliders
+            sliders ^= b
+            start = b.bit_length() - 1
+            targets = ROOK_TABLES[start][occupied & ROOK_MASKS[start]] & move_mask
+            if b & pinned:
+                targets &= pin_lines[start]
+            if not listing:
+                count += targets.bit_count()
+                continue
+            start_bits = start | (base + (QUEEN if b & queens else ROOK)) << PIECE_SHIFT
+            while targets:
+                t = targets & -targets
+                targets ^= t
+                end = t.bit_length() - 1
+                append(start_bits | end << 6 | capture_bits[board[end >> 3][end & 7]])
+        if stop_early and count:
+            return count
+
+        # pawns, unpinned ones are shifted as a whole set and pinned ones go one at a time
+        pawns = bitboards[base + PAWN]
+        pawn_bits = (base + PAWN) << PIECE_SHIFT
+        free = pawns & ~pinned
+        if us == WHITE:
+            forward, promotion_row = -8, ROW_MASKS[0]
+            single = (free >> 8) & empty
+            double = ((single & ROW_MASKS[5]) >> 8) & empty
+            left = ((free & ~COL_MASKS[0]) >> 9) & enemy
+            right = ((free & ~COL_MASKS[7]) >> 7) & enemy
+        else:
+            forward, promotion_row = 8, ROW_MASKS[7]
+            single = (free << 8) & empty
+            double = ((single & ROW_MASKS[2]) << 8) & empty
+            left = ((free & ~COL_MASKS[0]) << 7) & enemy
+            right = ((free & ~COL_MASKS[7]) << 9) & enemy
+        single &= target_mask
+        left &= target_mask
+        right &= target_mask
+        plain = []  # (targets, end - start, flag bits)
+        promotions = []  # (targets, end - start)
+        if quiets:
+            plain.append((single & ~promotion_row, forward, 0))
+            plain.append((double & target_mask, 2 * forward, FLAG_DOUBLE_PUSH << 12))
+        if captures:
+            plain.append((left & ~promotion_row, forward - 1, 0))
+            plain.append((right & ~promotion_row, forward + 1, 0))
+            promotions.append((single & promotion_row, forward))
+            promotions.append((left & promotion_row, forward - 1))
+            promotions.append((right & promotion_row, forward + 1))
+        for targets, delta, flag_bits in plain:
+            if not listing:
+                count += targets.bit_count()
+                continue
+            while targets:
+                t = targets & -targets
+                targets ^= t
+                end = t.bit_length() - 1
+                append((end - delta) | end << 6 | flag_bits | pawn_bits | capture_bits[board[end >> 3][end & 7]])
+        for targets, delta in promotions:
+            if not listing:
+                count += 4 * targets.bit_count()
+                continue
+            while targets:
+                t = targets & -targets
+                targets ^= t
+                end = t.bit_length() - 1
+                code = (end - delta) | end << 6 | pawn_bits | capture_bits[board[end >> 3][end & 7]]
+                for i in range(4):
+                    append(code | (FLAG_PROMOTION + i) << 12)
+        if stop_early and count:
+            return count
+
+        pawn_attacks = PAWN_ATTACKS[us]
+        pinned_pawns = pawns & pinned
+        while pinned_pawns:
+            b = pinned_pawns & -pinned_pawns
+            pinned_pawns ^= b
+            start = b.bit_length() - 1
+            targets = pawn_attacks[start] & enemy
+            one = start + forward
+            if empty >> one & 1:
+                targets |= 1 << one
+                if (start >> 3) == (6 if us == WHITE else 1) and empty >> (one + forward) & 1:
+                    targets |= 1 << (one + forward)
+            targets &= target_mask & pin_lines[start]
+            while targets:
+                t = targets & -targets
+                targets ^= t
+                if not (captures if t & (enemy | promotion_row) else quiets):
+                    continue
+                if not listing:
+                    count += 4 if t & promotion_row else 1
+                    continue
+                end = t.bit_length() - 1
+                code = start | end << 6 | pawn_bits | capture_bits[board[end >> 3][end & 7]]
+                if t & promotion_row:
+                    for i in range(4):
+                        append(code | (FLAG_PROMOTION + i) << 12)
+                elif end - start == 2 * forward:
+                    append(code | FLAG_DOUBLE_PUSH << 12)
                 else:
-                    self.get_king_moves(king_row, king_col, moves)
-            else:
-                moves = self.get_all_possible_moves()
+                    append(code)
+
+        # en passant, tested by lifting both pawns off the board since it can expose the king along a rank
+        ep = self.enpassant_square
+        if ep >= 0 and captures:
+            captured_sq = ep - forward
+            capturers = PAWN_ATTACKS[them][ep] & pawns
+            captured_bits = (enemy_base + PAWN + 1) << CAPTURE_SHIFT
+            while capturers:
+                b = capturers & -capturers
+                capturers ^= b
+                start = b.bit_length() - 1
+                after = (occupied ^ b ^ (1 << captured_sq)) | (1 << ep)
+                if not attackers_to(bitboards, king_sq, after, them) & ~(1 << captured_sq):
+                    if listing:
+                        append(start | ep << 6 | FLAG_ENPASSANT << 12 | pawn_bits | captured_bits)
+                    else:
+                        count += 1
 
-            return moves
+        # castling, the king can't castle out of, through or into check
+        if not checkers and quiets:
+            rights = self.castling_rights
+            king_bits = (base + KING) << PIECE_SHIFT | FLAG_CASTLE << 12
+            castles = []
+            if us == WHITE:
+                if rights & WHITE_KING_SIDE and not occupied & 0x6000000000000000 and \
+                        not attackers_to(bitboards, 61, occupied, them) and \
+                        not attackers_to(bitboards, 62, occupied, them):
+                    castles.append(60 | 62 << 6 | king_bits)
+                if rights & WHITE_QUEEN_SIDE and not occupied & 0x0E00000000000000 and \
+                        not attackers_to(bitboards, 59, occupied, them) and \
+                        not attackers_to(bitboards, 58, occupied, them):
+                    castles.append(60 | 58 << 6 | king_bits)
+            else:
+                if rights & BLACK_KING_SIDE and not occupied & 0x60 and \
+                        not attackers_to(bitboards, 5, occupied, them) and \
+                        not attackers_to(bitboards, 6, occupied, them):
+                    castles.append(4 | 6 << 6 | king_bits)
+                if rights & BLACK_QUEEN_SIDE and not occupied & 0x0E and \
+                        not attackers_to(bitboards, 3, occupied, them) and \
+                        not attackers_to(bitboards, 2, occupied, them):
+                    castles.append(4 | 2 << 6 | king_bits)
+            if listing:
+                moves.extend(castles)
+            else:
+                count += len(castles)
+        return moves if listing else count
 
     def check_for_pins_and_checks(self):
         pins = []
@@ -171,22 +799,35 @@ class GameState:
                         checks.append((end_row, end_col, k[0], k[1]))
             return in_check, pins, checks
 
-    # will determine if the current player is in check
-    def in_check(self):
-        if self.white_to_move:
-            return self.square_under_attack(self.white_king_location[0], self.white_king_location[1])
-        else:
-            return self.square_under_attack(self.black_king_location[0], self.black_king_location[1])
-
     # determine if the enemy can attack square row, col
     def square_under_attack(self, row, col):
-        self.white_to_move = not self.white_to_move  # switch the turn
-        opponent_moves = self.get_all_possible_moves()  # generate all possible moves
-        self.white_to_move = not self.white_to_move
-        for move in opponent_moves:
-            if move.end_row == row and move.end_col == col:  # meaning the square is under attack
-                return True
-        return False
+        enemy = BLACK if self.white_to_move else WHITE
+        return self.get_attack_map(enemy) >> (row * 8 + col) & 1 == 1
+
+    # bitboard of every square the colour attacks or defends. Both maps are built together the first
+    # time they are asked for in a position and reused until the zobrist key changes, so undoing back
+    # to a position doesn't rebuild them either
+    def get_attack_map(self, colour):
+        if self.attack_maps_key != self.zobrist_key:
+            occupied = self.occupancy[WHITE] | self.occupancy[BLACK]
+            self.attack_maps = [attack_map(self.bitboards, WHITE, occupied),
+                                attack_map(self.bitboards, BLACK, occupied)]
+            self.attack_maps_key = self.zobrist_key
+        return self.attack_maps[colour]
+
+    # the (row, col) of every piece of the given colour attacking square row, col
+    # (the enemy of the side to move if white is None)
+    def get_attackers(self, row, col, white=None):
+        if white is None:
+            white = not self.white_to_move
+        occupied = self.occupancy[WHITE] | self.occupancy[BLACK]
+        attackers = attackers_to(self.bitboards, row * 8 + col, occupied, WHITE if white else BLACK)
+        squares = []
+        while attackers:
+            b = attackers & -attackers
+            attackers ^= b
+            squares.append(divmod(b.bit_length() - 1, 8))
+        return squares
 
     # All moves without considering check
     def get_all_possible_moves(self):
@@ -346,15 +987,115 @@ class Move:
                      "e": 4, "f": 5, "g": 6, "h": 7}
     cols_to_files = {v: k for k, v in files_to_cols.items()}
 
-    def __init__(self, start_sq, end_sq, board):
-        self.start_row = start_sq[0]
-        self.start_col = start_sq[1]
-        self.end_row = end_sq[0]
-        self.end_col = end_sq[1]
+    # fixed attribute slots instead of a per-move __dict__, the generator creates a lot of these
+    __slots__ = ('start_row', 'start_col', 'end_row', 'end_col', 'piece_moved', 'piece_captured',
+                 'is_pawn_promotion', 'promotion_choice', 'is_enpassant_move', 'is_castle_move', 'move_Id', '_code')
+
+    def __init__(self, start_sq, end_sq, board, promotion_choice='Q'):
+        self.start_row = start_row = start_sq[0]
+        self.start_col = start_col = start_sq[1]
+        self.end_row = end_row = end_sq[0]
+        self.end_col = end_col = end_sq[1]
+
+        self.piece_moved = piece_moved = board[start_row][start_col]
+        self.piece_captured = board[end_row][end_col]
+        self.move_Id = start_row * 1000 + start_col * 100 + end_row * 10 + end_col
+        self._code = None  # worked out by the code property when first asked for
+
+        # special moves can all be told apart from the board, so a move built from two clicks
+        # matches the one the generator produced
+        if piece_moved[1] == 'p':
+            self.is_pawn_promotion = end_row == 0 or end_row == 7
+            self.promotion_choice = promotion_choice if self.is_pawn_promotion else None
+            if self.is_pawn_promotion:
+                self.move_Id += 10000 * PROMOTION_PIECES.index(promotion_choice)
+            self.is_enpassant_move = start_col != end_col and self.piece_captured == "--"
+            if self.is_enpassant_move:
+                self.piece_captured = 'bp' if piece_moved == 'wp' else 'wp'
+        else:
+            self.is_pawn_promotion = self.is_enpassant_move = False
+            self.promotion_choice = None
+        self.is_castle_move = piece_moved[1] == 'K' and abs(end_col - start_col) == 2
+
+    # the same move as a packed code, see ChessBitboard for the layout. Moves made from codes come with
+    # theirs, for the others it is only worked out on first use so the board generator doesn't pay for it
+    @property
+    def code(self):
+        code = self._code
+        if code is None:
+            if self.is_pawn_promotion:
+                flag = FLAG_PROMOTION + PROMOTION_PIECES.index(self.promotion_choice)
+            elif self.is_enpassant_move:
+                flag = FLAG_ENPASSANT
+            elif self.is_castle_move:
+                flag = FLAG_CASTLE
+            elif self.piece_moved[1] == 'p' and abs(self.end_row - self.start_row) == 2:
+                flag = FLAG_DOUBLE_PUSH
+            else:
+                flag = 0
+            code = self._code = ((self.start_row * 8 + self.start_col) | (self.end_row * 8 + self.end_col) << 6 |
+                                 flag << 12 | PIECE_INDEX.get(self.piece_moved, 0) << PIECE_SHIFT |
+                                 CAPTURE_BITS.get(self.piece_captured, 0))
+        return code
+
+    # move_Id of the move a packed move code describes
+    @staticmethod
+    def id_from_code(code):
+        start = code & 63
+        end = code >> 6 & 63
+        move_id = (start >> 3) * 1000 + (start & 7) * 100 + (end >> 3) * 10 + (end & 7)
+        flag = code >> 12 & 15
+        if flag >= FLAG_PROMOTION:
+            move_id += 10000 * (flag - FLAG_PROMOTION)
+        return move_id
+
+    # rebuilds a move from its move_Id in the position it is played in, None if there is no piece to move
+    @classmethod
+    def from_id(cls, move_id, board):
+        low = move_id % 10000  # start and end squares, the 10000s hold the promotion piece
+        start_row, start_col, end_row, end_col = low // 1000, low // 100 % 10, low // 10 % 10, low % 10
+        if board[start_row][start_col] == "--":
+            return None
+        return cls((start_row, start_col), (end_row, end_col), board, PROMOTION_PIECES[move_id // 10000])
+
+    # the move of a packed move code. A Move depends on nothing but its code and is never changed after it
+    # is made, so one Move per code is kept and handed out again (see MOVE_CACHE_SIZE)
+    @classmethod
+    def from_code(cls, code):
+        move = _move_cache.get(code)
+        if move is None or type(move) is not cls:
+            move = cls.decode(code)
+            if len(_move_cache) >= MOVE_CACHE_SIZE:
+                _move_cache.clear()
+            _move_cache[code] = move
+        return move
 
-        self.piece_moved = board[self.start_row][self.start_col]
-        self.piece_captured = board[self.end_row][self.end_col]
-        self.move_Id = self.start_row * 1000 + self.start_col * 100 + self.end_row * 10 + self.end_col
+    # builds a new move from a packed move code, everything it needs is in the code so the board isn't read
+    @classmethod
+    def decode(cls, code):
+        move = cls.__new__(cls)
+        start = code & 63
+        end = code >> 6 & 63
+        flag = code >> 12 & 15
+        captured = code >> CAPTURE_SHIFT
+        move._code = code
+        move.start_row = start_row = start >> 3
+        move.start_col = start_col = start & 7
+        move.end_row = end_row = end >> 3
+        move.end_col = end_col = end & 7
+        move.piece_moved = PIECES[code >> PIECE_SHIFT & 15]
+        move.piece_captured = PIECES[captured - 1] if captured else "--"
+        move.move_Id = start_row * 1000 + start_col * 100 + end_row * 10 + end_col
+        move.is_enpassant_move = flag == FLAG_ENPASSANT
+        move.is_castle_move = flag == FLAG_CASTLE
+        if flag >= FLAG_PROMOTION:
+            move.is_pawn_promotion = True
+            move.promotion_choice = PROMOTION_PIECES[flag - FLAG_PROMOTION]
+            move.move_Id += 10000 * (flag - FLAG_PROMOTION)
+        else:
+            move.is_pawn_promotion = False
+            move.promotion_choice = None
+        return move
 
     # overriding the equal method
     def __eq__(self, other):
@@ -362,8 +1103,22 @@ class Move:
             return self.move_Id == other.move_Id
         return False
 
+    # hashes like move_Id so equal moves land in the same set/dict slot
+    def __hash__(self):
+        return self.move_Id
+
     def get_chess_notations(self):
         return self.get_rank_file(self.end_row, self.end_col)
 
+    # long algebraic notation as used by UCI and perft divide, e.g. e2e4 or e7e8q
+    def get_uci_notation(self):
+        notation = self.get_rank_file(self.start_row, self.start_col) + self.get_rank_file(self.end_row, self.end_col)
+        if self.is_pawn_promotion:
+            notation += self.promotion_choice.lower()
+        return notation
+
     def get_rank_file(self, row, col):
         return self.cols_to_files[col] + self.row_to_ranks[row]
+
+
+_move_cache = {}  # move code -> Move, filled by Move.from_code
@@ -0,0 +1,324 @@
+# Opt-in instrumentation of the engine's hot paths. While an Instrumentation is enabled, the methods it
+# watches (see COUNTED and TIMED) are swapped on their classes for wrappers that count the calls and,
+# for the timed ones, add up the time spent in them. Disabling puts the original functions back, so
+# when it is off there is nothing in the way and the engine runs at full speed. Searches run through
+# run_search get a summary of nodes, cutoff rates, TT hits and time per phase. Everything exports as JSON.
+#
+# Only this process is instrumented, the helper processes of ChessParallel are not.
+#
+#   python ChessInstrumentation.py --time 5 --json stats.json
+#   python ChessInstrumentation.py --perft 4 --profile          also prints the top cProfile entries
+#   python ChessInstrumentation.py --generator 2000 --tracemalloc   the legacy pseudo-legal generator
+#
+#   with Instrumentation() as instrumentation:
+#       instrumentation.run_search(Search(), gs, 5)
+#   instrumentation.write_json("stats.json")
+
+import argparse
+import cProfile
+import io
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+import ChessEngine
+import ChessPerft
+import ChessSearch
+from ChessTablebase import Tablebases
+from ChessTranspositionTable import TranspositionTable
+
+# (owner, attribute) of the functions only counted
+COUNTED = [
+    (ChessEngine.GameState, 'get_valid_moves'),
+    (ChessEngine.Move, '__init__'),
+]
+# the old list-of-strings move generator. Search and perft never call it, so these counters (and the per
+# piece timers of PIECE_GENERATORS) are only watched with Instrumentation(legacy=True), as --generator does
+LEGACY_COUNTED = [
+    (ChessEngine.GameState, 'get_all_possible_moves'),
+    (ChessEngine.GameState, 'check_for_pins_and_checks'),
+    (ChessEngine.GameState, 'square_under_attack'),
+]
+# (owner, attribute) of the functions counted and timed. None of them calls another, so the times add up
+TIMED = [
+    (ChessEngine.GameState, 'generate_move_codes'),
+    (ChessEngine.GameState, 'make_move'),
+    (ChessEngine.GameState, 'undo_move'),
+    (ChessEngine.GameState, 'is_in_check'),
+    (ChessSearch, 'evaluate_relative'),
+    (TranspositionTable, 'probe'),
+    (TranspositionTable, 'store'),
+    (Tablebases, 'probe'),
+]
+# the legacy generators GameState.move_functions holds, timed per piece in the game states given to enable
+PIECE_GENERATORS = {'p': 'get_pawn_moves', 'R': 'get_rook_moves', 'N': 'get_knight_moves',
+                    'B': 'get_bishop_moves', 'Q': 'get_queen_moves', 'K': 'get_king_moves'}
+# search phases and the timed functions that make them up, the rest of the search time is 'search'
+PHASES = {
+    'move_generation': ['GameState.generate_move_codes'],
+    'make_undo': ['GameState.make_move', 'GameState.undo_move'],
+    'check_detection': ['GameState.is_in_check'],
+    'evaluation': ['ChessSearch.evaluate_relative'],
+    'transposition_table': ['TranspositionTable.probe', 'TranspositionTable.store'],
+    'tablebases': ['Tablebases.probe'],
+}
+
+
+def _name(owner, attribute):
+    return "%s.%s" % (owner.__name__.rpartition('.')[2], attribute)
+
+
+class Instrumentation:
+    # legacy also watches the old generator, see LEGACY_COUNTED
+    def __init__(self, legacy=False):
+        self.legacy = legacy
+        self.legacy_names = set()
+        self.counts = {}  # name -> calls
+        self.times = {}  # name -> seconds, for the timed functions
+        self.searches = []  # summaries of the searches run through run_search
+        self.originals = []  # (owner, attribute, original) while enabled
+        self.game_states = []
+
+    @property
+    def enabled(self):
+        return bool(self.originals)
+
+    # swaps the wrappers in. The legacy piece generators are bound per GameState (in move_functions), so
+    # they are only timed for the game states passed here
+    def enable(self, *game_states):
+        if self.enabled:
+            return
+        for owner, attribute in COUNTED:
+            self.patch(owner, attribute, self.counter(_name(owner, attribute)))
+        for owner, attribute in TIMED:
+            self.patch(owner, attribute, self.timer(_name(owner, attribute)))
+        self.patch(ChessEngine.Move, 'from_code', self.counter("Move.from_code"), wrap=classmethod)
+        self.patch(ChessEngine.Move, 'decode', self.counter("Move.decode"), wrap=classmethod)
+        if not self.legacy:
+            return
+        for owner, attribute in LEGACY_COUNTED:
+            self.legacy_names.add(_name(owner, attribute))
+            self.patch(owner, attribute, self.counter(_name(owner, attribute)))
+        timers = {}
+        for piece in PIECE_GENERATORS:
+            self.legacy_names.add("move_functions." + piece)
+            timers[piece] = self.timer("move_functions." + piece)
+        self.game_states = list(game_states)
+        for gs in self.game_states:
+            gs.move_functions = {piece: timers[piece](function) for piece, function in gs.move_functions.items()}
+
+    def disable(self):
+        for owner, attribute, original in reversed(self.originals):
+            setattr(owner, attribute, original)
+        self.originals = []
+        for gs in self.game_states:
+            bind_move_functions(gs)
+        self.game_states = []
+
+    # replaces owner.attribute with make_wrapper(original function), wrap rebuilds a classmethod
+    def patch(self, owner, attribute, make_wrapper, wrap=None):
+        original = owner.__dict__[attribute] if isinstance(owner, type) else getattr(owner, attribute)
+        function = original.__func__ if wrap is not None else original
+        wrapper = make_wrapper(function)
+        setattr(owner, attribute, wrap(wrapper) if wrap is not None else wrapper)
+        self.originals.append((owner, attribute, original))
+
+    def counter(self, name):
+        counts = self.counts
+        counts.setdefault(name, 0)
+
+        def make_wrapper(function):
+            def wrapper(*args, **kwargs):
+                counts[name] += 1
+                return function(*args, **kwargs)
+            return wrapper
+
+        return make_wrapper
+
+    def timer(self, name):
+        counts = self.counts
+        times = self.times
+        counts.setdefault(name, 0)
+        times.setdefault(name, 0.0)
+        clock = time.perf_counter
+
+        def make_wrapper(function):
+            def wrapper(*args, **kwargs):
+                counts[name] += 1
+                start = clock()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    times[name] += clock() - start
+            return wrapper
+
+        return make_wrapper
+
+    def reset(self):
+        for name in self.counts:
+            self.counts[name] = 0
+        for name in self.times:
+            self.times[name] = 0.0
+        self.searches = []
+
+    # total 'Move' allocations: moves built by the constructor and from packed codes, from_code calls
+    # answered from its cache don't allocate
+    def move_allocations(self):
+        return self.counts.get("Move.__init__", 0) + self.counts.get("Move.decode", 0)
+
+    # seconds per phase over elapsed seconds of searching, 'search' is the time not in any phase
+    def phase_times(self, elapsed, before=None):
+        phases = {}
+        for phase, names in PHASES.items():
+            phases[phase] = sum(self.times.get(name, 0.0) - (before or {}).get(name, 0.0) for name in names)
+        phases['search'] = max(0.0, elapsed - sum(phases.values()))
+        return phases
+
+    # runs search.search(gs, ...) and records the summary of it, returns the best move
+    def run_search(self, search, gs, time_limit, max_depth=64, max_nodes=None):
+        before = dict(self.times)
+        start = time.perf_counter()
+        move = search.search(gs, time_limit, max_depth, max_nodes)
+        elapsed = time.perf_counter() - start
+        summary = search.stats()
+        summary['time'] = elapsed
+        summary['nps'] = int(summary['nodes'] / elapsed) if elapsed > 0 else 0
+        summary['tt_hit_rate'] = summary['tt_hits'] / summary['tt_probes'] if summary['tt_probes'] else 0.0
+        summary['phases'] = self.phase_times(elapsed, before)
+        summary['bestmove'] = move.get_uci_notation() if move is not None else None
+        self.searches.append(summary)
+        return move
+
+    # counters and timers of the engine, the legacy generator's under 'legacy' when it was watched
+    def as_dict(self):
+        timers = {name: {'calls': self.counts[name], 'seconds': seconds,
+                         'mean_us': 1e6 * seconds / self.counts[name] if self.counts[name] else 0.0}
+                  for name, seconds in self.times.items()}
+        counters = {name: calls for name, calls in self.counts.items() if name not in self.times}
+        counters['Move allocations'] = self.move_allocations()
+        data = {'counters': {name: calls for name, calls in counters.items() if name not in self.legacy_names},
+                'timers': {name: timer for name, timer in timers.items() if name not in self.legacy_names},
+                'searches': self.searches}
+        if self.legacy_names:
+            legacy = self.legacy_names
+            data['legacy'] = {'counters': {name: calls for name, calls in counters.items() if name in legacy},
+                              'timers': {name: timer for name, timer in timers.items() if name in legacy}}
+        return data
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self.disable()
+
+
+# rebuilds a GameState's move_functions from its methods, dropping the timing wrappers
+def bind_move_functions(gs):
+    gs.move_functions = {piece: getattr(gs, attribute) for piece, attribute in PIECE_GENERATORS.items()}
+
+
+# runs the block under cProfile and writes the top entries by sort to out (stderr by default).
+# Yields the Profile, which can be dumped with dump_stats for a viewer
+@contextmanager
+def profiled(sort='cumulative', limit=25, out=None):
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats(sort).print_stats(limit)
+        (out or sys.stderr).write(text.getvalue())
+
+
+# traces the allocations of the block and writes the limit source lines holding the most memory at its
+# end, and the peak, to out (stderr by default)
+@contextmanager
+def traced_allocations(limit=15, out=None):
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        out = out or sys.stderr
+        out.write("peak traced memory %.1f KiB\n" % (peak / 1024))
+        for stat in snapshot.statistics('lineno')[:limit]:
+            out.write("%s\n" % stat)
+
+
+# one line per counter and timer, the legacy generator's after a heading, then the search summaries
+def format_report(data):
+    lines = []
+    sections = [data]
+    if 'legacy' in data:
+        sections.append(data['legacy'])
+    for section in sections:
+        if section is not data:
+            lines.append("legacy list-of-strings generator (get_all_possible_moves and move_functions):")
+        for name, calls in sorted(section['counters'].items()):
+            lines.append("%-36s %12d" % (name, calls))
+        for name, timer in sorted(section['timers'].items(), key=lambda item: -item[1]['seconds']):
+            lines.append("%-36s %12d calls %9.3f s %8.2f us/call" % (name, timer['calls'], timer['seconds'],
+                                                                       timer['mean_us']))
+    for summary in data['searches']:
+        lines.append("search depth %d nodes %d (quiescence %d) nps %d cutoffs %.1f%% first move %.1f%% "
+                     "tt hits %.1f%% tbhits %d bestmove %s" % (
+                         summary['depth'], summary['nodes'], summary['quiescence_nodes'], summary['nps'],
+                         100 * summary['cutoff_rate'], 100 * summary['first_move_cutoff_rate'],
+                         100 * summary['tt_hit_rate'], summary['tb_hits'], summary['bestmove']))
+        lines.append("  phases " + ", ".join("%s %.3f s" % item for item in summary['phases'].items()))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a search, perft or the piece generators with counters on")
+    parser.add_argument("--fen", default=None, help="position, defaults to the start position")
+    parser.add_argument("--time", type=float, default=5.0, help="search time in seconds")
+    parser.add_argument("--depth", type=int, default=64, help="maximum search depth")
+    parser.add_argument("--perft", type=int, default=None, metavar="DEPTH", help="run perft instead of a search")
+    parser.add_argument("--generator", type=int, default=None, metavar="N",
+                        help="run the legacy pseudo-legal generator N times instead of a search, "
+                             "the only run that reports its counters")
+    parser.add_argument("--json", default=None, help="write the counters and summaries to this file")
+    parser.add_argument("--profile", action="store_true", help="also run under cProfile")
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace memory allocations")
+    args = parser.parse_args(argv)
+
+    gs = ChessEngine.GameState(args.fen)
+    search = ChessSearch.Search()
+    instrumentation = Instrumentation(legacy=args.generator is not None)
+    with profiled() if args.profile else nullcontext(), traced_allocations() if args.tracemalloc else nullcontext():
+        instrumentation.enable(gs)
+        try:
+            if args.perft is not None:
+                print("perft %d: %d" % (args.perft, ChessPerft.perft(gs, args.perft)))
+            elif args.generator is not None:
+                for _ in range(args.generator):
+                    gs.get_all_possible_moves()
+            else:
+                instrumentation.run_search(search, gs, args.time, args.depth)
+        finally:
+            instrumentation.disable()
+    print(format_report(instrumentation.as_dict()))
+    if args.json:
+        instrumentation.write_json(args.json)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,37 @@
 # This is our main driver file
+#
+#   python ChessMain.py                              two players on one board
+#   python ChessMain.py --engine black --time 3      play white against the engine
+#   python ChessMain.py --benchmark 500              time the board redraws without a window, for CI
+#
+# The board is drawn in full once and after that only the squares the last move (or undo) changed are
+# redrawn and updated on the display. Legal moves and the engine's moves are worked out on a background
+# thread which posts them back as pygame events, so the event loop never waits on the engine.
+
+import argparse
+import os
+import pickle
+import queue
+import random
+import sys
+import threading
+import time
 
 import pygame as p
 
 import ChessEngine
+from ChessSearch import Search, SearchTimeout
 
 WIDTH = HEIGHT = 512
 DIMENSION = 8
 SQ_SIZE = HEIGHT // DIMENSION
 MAX_FPS = 15  # For animations later on
 IMAGES = {}
+BOARD_COLORS = [p.Color("white"), p.Color("dark green")]
+DEFAULT_ENGINE_TIME = 2.0  # seconds the engine thinks per move
+# posted by the EngineWorker, both carry the token of the position they belong to
+VALID_MOVES_EVENT = p.USEREVENT  # .moves is the set of legal moves
+ENGINE_MOVE_EVENT = p.USEREVENT + 1  # .move is the engine's move, None without legal moves
 
 
 # Initialize a global dictionary of images and will be called exactly once in main
@@ -20,17 +43,100 @@ def load_images():
     # We can access an image by saying IMAGES['wp']
 
 
+# the worker's search, it gives up as soon as the position it was asked about is no longer the current one
+class WorkerSearch(Search):
+    def __init__(self, worker):
+        super().__init__()
+        self.worker = worker
+        self.token = None
+
+    def check_time(self):
+        if self.worker.token != self.token:
+            raise SearchTimeout()
+        super().check_time()
+
+
+# Works out legal moves and engine moves on a background thread. Jobs carry a copy of the position and the
+# token the event loop gave it, answers come back as pygame events with the same token. Jobs and searches
+# of a position the loop has left since are dropped
+class EngineWorker:
+    def __init__(self, time_limit=DEFAULT_ENGINE_TIME):
+        self.time_limit = time_limit
+        self.token = None  # token of the current position
+        self.search = WorkerSearch(self)
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # a new current position: its legal moves are sent and, with think set, the engine's move after them
+    def set_position(self, gs, token, think=False):
+        self.token = token
+        state = pickle.dumps(gs)
+        self.jobs.put((VALID_MOVES_EVENT, state, token))
+        if think:
+            self.jobs.put((ENGINE_MOVE_EVENT, state, token))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            kind, state, token = job
+            if token != self.token:
+                continue
+            gs = pickle.loads(state)
+            if kind == VALID_MOVES_EVENT:
+                p.event.post(p.event.Event(VALID_MOVES_EVENT, token=token, moves=set(gs.get_valid_moves())))
+            else:
+                self.search.token = token
+                move = self.search.search(gs, self.time_limit)
+                if token == self.token:
+                    p.event.post(p.event.Event(ENGINE_MOVE_EVENT, token=token, move=move))
+
+    def close(self):
+        self.token = None
+        self.jobs.put(None)
+        self.thread.join()
+
+
 # The main function that will handle user input and graphics
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play chess on a board in a window")
+    parser.add_argument("--engine", choices=("white", "black", "both"), default=None,
+                        help="the side(s) the engine plays")
+    parser.add_argument("--time", type=float, default=DEFAULT_ENGINE_TIME, help="engine time per move in seconds")
+    parser.add_argument("--fen", default=None, help="start position, defaults to the initial position")
+    parser.add_argument("--benchmark", type=int, default=None, metavar="MOVES",
+                        help="time full and dirty square redraws over MOVES random moves and exit")
+    args = parser.parse_args(argv)
+
+    if args.benchmark is not None:  # no window needed, unless SDL_VIDEODRIVER asks for one
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
     p.init()
     screen = p.display.set_mode((WIDTH, HEIGHT))
+    load_images()
+    try:
+        if args.benchmark is not None:
+            return benchmark(screen, args.benchmark)
+        engine_colours = {'white': {'w'}, 'black': {'b'}, 'both': {'w', 'b'}}.get(args.engine, set())
+        play(screen, ChessEngine.GameState(args.fen), engine_colours, args.time)
+        return 0
+    finally:
+        p.quit()
+
+
+# the event loop, engine_colours holds 'w' and/or 'b' for the sides the engine plays
+def play(screen, gs, engine_colours, time_limit):
     clock = p.time.Clock()
-    screen.fill(p.Color("white"))
-    gs = ChessEngine.GameState()
-    valid_moves = gs.get_valid_moves_naive()
+    worker = EngineWorker(time_limit)
+    token = 0  # goes up with every change of position
+    valid_moves = None  # a set so checking a clicked move is a hash lookup, None until the worker sends it
     move_made = False  # flag variable when the move is made
+    dirty = set()  # squares to redraw
 
-    load_images()
+    draw_game_state(screen, gs)
+    p.display.flip()
+    worker.set_position(gs, token, current_colour(gs) in engine_colours)
     running = True
     sq_selected = ()  # No square selected initially, keeps track of last click of the user  (row, column)
     player_clicks = []  # keeps track of player clicks (two tuples : [(7,4),(4,4)]
@@ -39,7 +145,9 @@ def main():
             if e.type == p.QUIT:
                 running = False
             elif e.type == p.MOUSEBUTTONDOWN:
-                location = p.mouse.get_pos()  # (x,y) location of mouse
+                if valid_moves is None or current_colour(gs) in engine_colours:
+                    continue
+                location = e.pos  # (x,y) location of mouse
                 col = location[0] // SQ_SIZE
                 row = location[1] // SQ_SIZE
                 if sq_selected == (row, col):  # if the square is the same that was selected before
@@ -53,6 +161,7 @@ def main():
                     print(move.get_chess_notations())
                     if move in valid_moves:  # only valid moves are made
                         gs.make_move(move)
+                        dirty |= dirty_squares(move)
                         move_made = True
                         if gs.white_to_move:
                             print("white's turn")
@@ -62,17 +171,51 @@ def main():
                     player_clicks = []
             # key handler
             elif e.type == p.KEYDOWN:
-                if e.key == p.K_z:
+                if e.key == p.K_z and gs.move_log:
+                    dirty |= dirty_squares(gs.move_log[-1])
                     gs.undo_move()
+                    if current_colour(gs) in engine_colours and len(engine_colours) == 1 and gs.move_log:
+                        dirty |= dirty_squares(gs.move_log[-1])  # back to the player's own move
+                        gs.undo_move()
+                    move_made = True
+            elif e.type == VALID_MOVES_EVENT:
+                if e.token == token:
+                    valid_moves = e.moves
+            elif e.type == ENGINE_MOVE_EVENT:
+                if e.token == token and e.move is not None:
+                    print(e.move.get_chess_notations())
+                    gs.make_move(e.move)
+                    dirty |= dirty_squares(e.move)
                     move_made = True
+            elif e.type == p.VIDEOEXPOSE:  # the window was uncovered, everything needs drawing again
+                draw_game_state(screen, gs)
+                p.display.flip()
 
         if move_made:
-            valid_moves = gs.get_valid_moves_naive()
+            token += 1
+            valid_moves = None
+            worker.set_position(gs, token, current_colour(gs) in engine_colours)
             move_made = False
-
+        if dirty:
+            p.display.update(draw_squares(screen, gs.board, dirty))
+            dirty = set()
         clock.tick(MAX_FPS)
-        p.display.flip()
-        draw_game_state(screen, gs)
+    worker.close()
+
+
+def current_colour(gs):
+    return 'w' if gs.white_to_move else 'b'
+
+
+# squares a move changes on the board, the same when it is undone
+def dirty_squares(move):
+    squares = {(move.start_row, move.start_col), (move.end_row, move.end_col)}
+    if move.is_enpassant_move:
+        squares.add((move.start_row, move.end_col))  # the captured pawn
+    elif move.is_castle_move:
+        rook_cols = (7, 5) if move.end_col - move.start_col == 2 else (0, 3)
+        squares.update((move.end_row, col) for col in rook_cols)
+    return squares
 
 
 # Responsible for all graphics in the current state
@@ -83,10 +226,9 @@ def draw_game_state(screen, gs):
 
 # Draw squares on the board
 def draw_board(screen):
-    colors = [p.Color("white"), p.Color("dark green")]
     for row in range(DIMENSION):
         for col in range(DIMENSION):
-            color = colors[((row + col) % 2)]
+            color = BOARD_COLORS[((row + col) % 2)]
             p.draw.rect(screen, color, p.Rect(col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
 
 
@@ -99,5 +241,63 @@ def draw_piece(screen, board):
                 screen.blit(IMAGES[piece], p.Rect(col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE))
 
 
+# Draw only the given (row, col) squares with their pieces, returns their rects for display.update
+def draw_squares(screen, board, squares):
+    rects = []
+    for row, col in squares:
+        rect = p.Rect(col * SQ_SIZE, row * SQ_SIZE, SQ_SIZE, SQ_SIZE)
+        p.draw.rect(screen, BOARD_COLORS[(row + col) % 2], rect)
+        piece = board[row][col]
+        if piece != '--':
+            screen.blit(IMAGES[piece], rect)
+        rects.append(rect)
+    return rects
+
+
+# Times the render path: random legal moves (undone again when a game ends) are played and the board is
+# redrawn after each, first in full and then only its dirty squares. Checks both end on the same picture,
+# returns 0 if they do
+def benchmark(screen, moves, seed=0):
+    rng = random.Random(seed)
+    gs = ChessEngine.GameState()
+    steps = []  # (move, undo)
+    for _ in range(moves):
+        valid_moves = gs.get_valid_moves()
+        if valid_moves:
+            move = rng.choice(valid_moves)
+            gs.make_move(move)
+            steps.append((move, False))
+        else:
+            steps.append((gs.move_log[-1], True))
+            gs.undo_move()
+
+    results = {}
+    pictures = {}
+    for mode in ('full', 'dirty'):
+        gs = ChessEngine.GameState()
+        draw_game_state(screen, gs)
+        p.display.flip()
+        start = time.perf_counter()
+        for move, undo in steps:
+            if undo:
+                gs.undo_move()
+            else:
+                gs.make_move(move)
+            if mode == 'full':
+                draw_game_state(screen, gs)
+                p.display.flip()
+            else:
+                p.display.update(draw_squares(screen, gs.board, dirty_squares(move)))
+        results[mode] = time.perf_counter() - start
+        pictures[mode] = p.image.tostring(screen, 'RGB')
+    for mode, elapsed in results.items():
+        print("%-5s %6d frames %8.3f s %10.1f frames/s" % (mode, len(steps), elapsed,
+                                                           len(steps) / elapsed if elapsed > 0 else 0))
+    same = pictures['full'] == pictures['dirty']
+    print("dirty square redraw %s the full redraw (video driver %s)" % ("matches" if same else "DIFFERS from",
+                                                                          p.display.get_driver()))
+    return 0 if same else 1
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
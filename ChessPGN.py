@@ -0,0 +1,148 @@
+# PGN games: a streaming reader for PGN files and conversion between standard algebraic notation (SAN)
+# and Move. Files are read through ChessEPD.read_lines, so collections of any size go through with
+# constant memory, one game at a time.
+#
+#   for headers, sans, result in read_games("games.pgn"): ...
+#   for headers, gs in read_game_states("games.pgn"): ...     gs.move_log holds the game's moves
+
+import re
+
+import ChessEngine
+from ChessEPD import read_lines
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+_HEADER = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# comments, variation brackets, NAGs, move numbers, results and moves
+_TOKEN = re.compile(r'\{[^}]*\}?|;[^\n]*|[()]|\$\d+|\d+\.+|1-0|0-1|1/2-1/2|\*|[^\s{}();$]+')
+_SAN = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?$')
+
+
+# yields (headers, sans, result) for every game in the file: the tag pairs as a dict, the moves of the
+# main line in SAN (comments, variations and NAGs dropped) and the result token
+def read_games(path):
+    headers = {}
+    sans = []
+    depth = 0  # nesting of variations
+    comment = False  # inside a { } comment running over several lines
+    for line in read_lines(path):
+        if comment:
+            end = line.find('}')
+            if end < 0:
+                continue
+            line = line[end + 1:]
+            comment = False
+        stripped = line.strip()
+        if stripped.startswith('[') and not sans and depth == 0:
+            match = _HEADER.match(stripped)
+            if match:
+                headers[match.group(1)] = match.group(2).replace('\\"', '"')
+            continue
+        if stripped.startswith('%'):  # escape line
+            continue
+        for token in _TOKEN.findall(line):
+            first = token[0]
+            if first == '{':
+                comment = not token.endswith('}')
+            elif first == ';' or first == '$' or first.isdigit() and token.endswith('.'):
+                continue
+            elif token == '(':
+                depth += 1
+            elif token == ')':
+                depth = max(0, depth - 1)
+            elif depth:
+                continue
+            elif token in RESULTS:
+                yield headers, sans, token
+                headers, sans = {}, []
+            else:
+                sans.append(token)
+            if comment:
+                break
+    if sans or headers:  # last game without a result
+        yield headers, sans, '*'
+
+
+# yields (headers, GameState) for every game, the GameState has played the game so its move_log holds
+# the moves. Games with an illegal or unreadable move are skipped unless strict is set
+def read_game_states(path, strict=False):
+    for headers, sans, result in read_games(path):
+        try:
+            gs = replay(headers, sans)
+        except ValueError:
+            if strict:
+                raise
+            continue
+        yield headers, gs
+
+
+# plays a game's SAN moves from its start position (the FEN tag or the initial position)
+def replay(headers, sans):
+    gs = ChessEngine.GameState(headers.get('FEN'))
+    for san in sans:
+        gs.make_move(move_from_san(gs, san))
+    return gs
+
+
+# the legal Move a SAN string describes, raises ValueError if there is none or more than one
+def move_from_san(gs, san, valid_moves=None):
+    text = san.rstrip('+#!?')
+    if valid_moves is None:
+        valid_moves = gs.get_valid_moves()
+    if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        end_col = 6 if len(text) == 3 else 2
+        for move in valid_moves:
+            if move.is_castle_move and move.end_col == end_col:
+                return move
+        raise ValueError("illegal move " + san)
+    match = _SAN.match(text)
+    if not match:
+        raise ValueError("unreadable move " + san)
+    piece, from_file, from_rank, target, promotion = match.groups()
+    piece = piece or 'p'
+    end_row = ChessEngine.Move.ranks_to_rows[target[1]]
+    end_col = ChessEngine.Move.files_to_cols[target[0]]
+    found = None
+    for move in valid_moves:
+        if (move.end_row != end_row or move.end_col != end_col or move.piece_moved[1] != piece or
+                (from_file and move.start_col != ChessEngine.Move.files_to_cols[from_file]) or
+                (from_rank and move.start_row != ChessEngine.Move.ranks_to_rows[from_rank]) or
+                move.promotion_choice != promotion):
+            continue
+        if found is not None:
+            raise ValueError("ambiguous move " + san)
+        found = move
+    if found is None:
+        raise ValueError("illegal move " + san)
+    return found
+
+
+# SAN of a legal move in the position it is played from, e.g. Nbd7, exd6, e8=Q+, O-O-O#
+def to_san(gs, move, valid_moves=None):
+    if valid_moves is None:
+        valid_moves = gs.get_valid_moves()
+    if move.is_castle_move:
+        san = "O-O" if move.end_col == 6 else "O-O-O"
+    else:
+        target = move.get_rank_file(move.end_row, move.end_col)
+        kind = move.piece_moved[1]
+        if kind == 'p':
+            san = (move.cols_to_files[move.start_col] + "x" if move.piece_captured != "--" else "") + target
+            if move.is_pawn_promotion:
+                san += "=" + move.promotion_choice
+        else:
+            rivals = [other for other in valid_moves if other.piece_moved == move.piece_moved and
+                      other.end_row == move.end_row and other.end_col == move.end_col and other != move]
+            prefix = ""
+            if rivals:
+                if all(other.start_col != move.start_col for other in rivals):
+                    prefix = move.cols_to_files[move.start_col]
+                elif all(other.start_row != move.start_row for other in rivals):
+                    prefix = move.row_to_ranks[move.start_row]
+                else:
+                    prefix = move.get_rank_file(move.start_row, move.start_col)
+            san = kind + prefix + ("x" if move.piece_captured != "--" else "") + target
+    gs.make_move(move)
+    if gs.is_in_check():
+        san += "+" if gs.has_legal_move() else "#"
+    gs.undo_move()
+    return san
@@ -0,0 +1,203 @@
+# Lazy SMP parallel search. The main search runs in this process while helper searches run in a pool
+# of worker processes, each on its own copy of the GameState. All of them share one transposition table
+# in a multiprocessing.shared_memory block, so what one search stores the others find. Helpers skip some
+# depths of the iterative deepening (the Stockfish skip pattern) so they spread out over the tree instead
+# of repeating the main search. With one worker there are no helpers and the result is exactly that of
+# ChessSearch.Search.
+#
+#   python ChessParallel.py --workers 8 --time 5
+#   python ChessParallel.py --scaling --workers 8 --time 5     nps with 1, 2, 4 ... 8 workers
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import sys
+import time
+from multiprocessing import shared_memory
+
+import ChessEngine
+from ChessSearch import Search, SearchTimeout, format_info
+from ChessTablebase import Tablebases
+from ChessTranspositionTable import TranspositionTable, table_bytes
+
+# helper i (from 1) searches depth d unless (d + SKIP_PHASE[j]) // SKIP_SIZE[j] is odd, j = (i - 1) % 20
+SKIP_SIZE = [1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4]
+SKIP_PHASE = [0, 1, 0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 4, 5, 6, 7]
+
+
+# a helper's search: depths are skipped by its index and it also stops when the main search is done
+class HelperSearch(Search):
+    def __init__(self, index, stop_event, tt, tablebases=None):
+        super().__init__(tt=tt, tablebases=tablebases)
+        self.index = index
+        self.stop_event = stop_event
+
+    def depths(self, max_depth):
+        j = (self.index - 1) % len(SKIP_SIZE)
+        return [depth for depth in range(1, max_depth + 1) if (depth + SKIP_PHASE[j]) // SKIP_SIZE[j] % 2 == 0]
+
+    def check_time(self):
+        if self.stop_event.is_set():
+            raise SearchTimeout()
+        super().check_time()
+
+
+# state of a pool worker process, set up once by _init_helper
+_helper_tt = None
+_helper_stop = None
+_helper_tablebases = None
+_helper_searches = {}
+
+
+# tablebase_settings is (directory, cache size) of the main search's tablebases or None
+def _init_helper(shm, hash_mb, stop_event, tablebase_settings):
+    global _helper_tt, _helper_stop, _helper_tablebases
+    _helper_tt = TranspositionTable(hash_mb, buffer=shm.buf)
+    _helper_stop = stop_event
+    if tablebase_settings is not None:
+        _helper_tablebases = Tablebases(*tablebase_settings)
+
+
+# runs in a worker process. Helpers are given twice the time so their own clock never stops them before
+# the main search does, the stop event ends them
+def _run_helper(state, index, time_limit, max_depth, age):
+    gs = pickle.loads(state)
+    search = _helper_searches.get(index)
+    if search is None:
+        search = _helper_searches[index] = HelperSearch(index, _helper_stop, _helper_tt, _helper_tablebases)
+    search.tt.age = age
+    move = search.search(gs, 2 * time_limit + 1, max_depth)
+    return worker_result(index, search, move)
+
+
+def worker_result(index, search, move):
+    info = search.info[-1] if search.info else {'depth': 0, 'score': 0, 'pv': []}
+    elapsed = time.perf_counter() - search.start_time
+    return {'worker': index, 'nodes': search.nodes, 'time': elapsed,
+            'nps': int(search.nodes / elapsed) if elapsed > 0 else 0, 'depth': info['depth'],
+            'score': info['score'], 'move': move.code if move is not None else 0, 'pv': info['pv']}
+
+
+class ParallelSearch:
+    # with tablebases (a ChessTablebase.Tablebases) every helper opens the same tables with its own cache
+    def __init__(self, workers=None, info_callback=None, hash_mb=16, tablebases=None):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.hash_mb = hash_mb
+        self.shm = shared_memory.SharedMemory(create=True, size=table_bytes(hash_mb))
+        self.main = Search(info_callback, tt=TranspositionTable(hash_mb, buffer=self.shm.buf), tablebases=tablebases)
+        self.stop_event = multiprocessing.Event()
+        self.pool = None
+        if self.workers > 1:
+            settings = (tablebases.directory, tablebases.cache_size) if tablebases is not None else None
+            self.pool = multiprocessing.Pool(self.workers - 1, _init_helper,
+                                             (self.shm, hash_mb, self.stop_event, settings))
+        self.worker_stats = []  # one result dict per worker of the last search, the main search first
+        self.nodes = 0
+        self.info = []
+
+    @property
+    def tt(self):
+        return self.main.tt
+
+    # asks a running search to return its best move so far, safe to call from another thread
+    def stop(self):
+        self.main.stop()
+        self.stop_event.set()
+
+    # same as Search.prepare, clears an earlier stop before the next search
+    def prepare(self):
+        self.main.prepare()
+        self.stop_event.clear()
+
+    # same as Search.search, max_nodes only limits the main search. When several workers finished a depth
+    # the move of the deepest one is played, the main search's move on a tie
+    def search(self, gs, time_limit, max_depth=64, max_nodes=None):
+        if not self.main.stopped:  # the event is set after every search to end the helpers
+            self.stop_event.clear()
+        age = self.main.tt.age
+        # pickled here, the pool would otherwise pickle gs in its own thread while the main search moves on it
+        state = pickle.dumps(gs)
+        pending = [self.pool.apply_async(_run_helper, (state, index, time_limit, max_depth, age))
+                   for index in range(1, self.workers)] if self.pool is not None else []
+        move = self.main.search(gs, time_limit, max_depth, max_nodes)
+        self.stop_event.set()
+        results = [worker_result(0, self.main, move)] + [result.get() for result in pending]
+        self.worker_stats = results
+        self.nodes = sum(result['nodes'] for result in results)
+        self.info = self.main.info
+        best = max(results, key=lambda result: (result['depth'], -result['worker']))
+        if best['worker'] != 0 and best['move']:
+            move = ChessEngine.Move.from_code(best['move'])
+        return move
+
+    # shuts the worker processes down and frees the shared table
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.shm is not None:
+            self.main.tt.release()
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# searches the position with 1, 2, 4 ... max_workers workers and returns one row per worker count:
+# (workers, total nodes, nps, nps per worker, speedup in nps over one worker)
+def nps_scaling(gs, time_limit, max_workers, hash_mb=16):
+    counts = []
+    workers = 1
+    while workers < max_workers:
+        counts.append(workers)
+        workers *= 2
+    counts.append(max_workers)
+    rows = []
+    base_nps = 0
+    for workers in counts:
+        with ParallelSearch(workers, hash_mb=hash_mb) as search:
+            search.search(gs, time_limit)
+            nps = sum(result['nps'] for result in search.worker_stats)
+        base_nps = base_nps or nps
+        rows.append((workers, search.nodes, nps, nps // workers, nps / base_nps if base_nps else 0.0))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search a position with several processes sharing one hash table")
+    parser.add_argument("--fen", default=None, help="position to search, defaults to the start position")
+    parser.add_argument("--time", type=float, default=5.0, help="time budget in seconds")
+    parser.add_argument("--depth", type=int, default=64, help="maximum depth")
+    parser.add_argument("--hash", type=int, default=64, help="shared transposition table size in megabytes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of search processes")
+    parser.add_argument("--scaling", action="store_true",
+                        help="report nps for 1, 2, 4 ... --workers workers instead of a single search")
+    args = parser.parse_args(argv)
+
+    gs = ChessEngine.GameState(args.fen)
+    if args.scaling:
+        for workers, nodes, nps, per_worker, speedup in nps_scaling(gs, args.time, args.workers, args.hash):
+            print("workers %3d  nodes %10d  nps %8d  nps/worker %7d  speedup %.2fx  efficiency %3d%%" % (
+                workers, nodes, nps, per_worker, speedup, 100 * speedup / workers))
+        return 0
+
+    with ParallelSearch(args.workers, lambda info: print(format_info(info)), args.hash) as search:
+        move = search.search(gs, args.time, args.depth)
+        for result in search.worker_stats:
+            print("worker %d depth %d nodes %d nps %d bestmove %s" % (
+                result['worker'], result['depth'], result['nodes'], result['nps'],
+                ChessEngine.Move.from_code(result['move']).get_uci_notation() if result['move'] else "(none)"))
+        print("tt %s" % ", ".join("%s %s" % item for item in search.tt.stats().items()))
+    print("bestmove %s" % (move.get_uci_notation() if move is not None else "(none)"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
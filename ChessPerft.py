@@ -0,0 +1,140 @@
+# Perft: counts the leaf nodes of the legal move tree to a fixed depth. Comparing the counts with
+# published reference numbers checks the move generator, and the nodes per second measure its speed.
+#
+#   python ChessPerft.py --depth 4                 perft of the start position
+#   python ChessPerft.py --fen "<fen>" --depth 3 --divide
+#   python ChessPerft.py --suite --max-nodes 5000000
+#   python ChessPerft.py --epd perftsuite.epd      positions with ;D1 20 ;D2 400 ... counts, read as a stream
+
+import argparse
+import sys
+import time
+
+import ChessEngine
+from ChessEPD import read_positions
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# (name, fen, expected node counts for depth 1, 2, ...) from the chessprogramming wiki perft results
+REFERENCE_POSITIONS = [
+    ("startpos", START_FEN,
+     [20, 400, 8902, 197281, 4865609, 119060324]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603, 193690690]),
+    ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624, 11030083]),
+    ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333, 15833292]),
+    ("position4_mirrored", "r2q1rk1/pP1p2pp/Q4n2/bbp1p3/Np6/1B3NBn/pPPP1PPP/R3K2R b KQ - 0 1",
+     [6, 264, 9467, 422333, 15833292]),
+    ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487, 89941194]),
+    ("position6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594, 164075551]),
+]
+
+
+# number of leaf nodes depth plies below the current position, the last ply is counted without being played
+def perft(gs, depth):
+    if depth == 0:
+        return 1
+    codes = gs.get_valid_move_codes()
+    if depth == 1:
+        return len(codes)
+    nodes = 0
+    for code in codes:
+        gs.make_move(ChessEngine.Move.from_code(code))
+        nodes += perft(gs, depth - 1)
+        gs.undo_move()
+    return nodes
+
+
+# perft split by root move, returns a list of (move in UCI notation, nodes)
+def divide(gs, depth):
+    results = []
+    for move in gs.get_valid_moves():
+        gs.make_move(move)
+        results.append((move.get_uci_notation(), perft(gs, depth - 1)))
+        gs.undo_move()
+    return results
+
+
+# runs perft and returns (nodes, seconds)
+def timed_perft(gs, depth):
+    start = time.perf_counter()
+    nodes = perft(gs, depth)
+    return nodes, time.perf_counter() - start
+
+
+def nodes_per_second(nodes, seconds):
+    return int(nodes / seconds) if seconds > 0 else 0
+
+
+# (name, fen, expected counts) of the positions of an EPD file with perft counts as D1, D2 ... operations,
+# read lazily so run_suite can go through files of any size
+def epd_suite(path):
+    for number, (fen, operations) in enumerate(read_positions(path), 1):
+        expected = []
+        while "D%d" % (len(expected) + 1) in operations:
+            expected.append(int(operations["D%d" % (len(expected) + 1)]))
+        yield operations.get('id', "%s:%d" % (path, number)), fen, expected
+
+
+# checks every reference position up to the deepest depth whose count is at most max_nodes,
+# prints one line per position and depth and returns True if every count matched
+def run_suite(max_nodes=1000000, positions=REFERENCE_POSITIONS, out=sys.stdout):
+    all_passed = True
+    total_nodes = 0
+    total_seconds = 0.0
+    for name, fen, expected in positions:
+        gs = ChessEngine.GameState(fen)
+        for depth, expected_nodes in enumerate(expected, 1):
+            if expected_nodes > max_nodes:
+                break
+            nodes, seconds = timed_perft(gs, depth)
+            total_nodes += nodes
+            total_seconds += seconds
+            passed = nodes == expected_nodes
+            all_passed = all_passed and passed
+            print("%-20s depth %d  nodes %10d  expected %10d  %s  %.2fs  %d nps" % (
+                name, depth, nodes, expected_nodes, "ok" if passed else "FAIL", seconds,
+                nodes_per_second(nodes, seconds)), file=out)
+    print("total nodes %d in %.2fs, %d nps, %s" % (total_nodes, total_seconds,
+                                                   nodes_per_second(total_nodes, total_seconds),
+                                                   "all passed" if all_passed else "FAILURES"), file=out)
+    return all_passed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perft move generator benchmark and correctness check")
+    parser.add_argument("--fen", default=START_FEN, help="position to search, defaults to the start position")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--divide", action="store_true", help="print the node count below each root move")
+    parser.add_argument("--suite", action="store_true", help="check the reference positions against known counts")
+    parser.add_argument("--epd", help="check the positions of an EPD file against their ;D1 ;D2 ... counts")
+    parser.add_argument("--max-nodes", type=int, default=1000000,
+                        help="with --suite or --epd, skip depths whose expected count is larger than this")
+    args = parser.parse_args(argv)
+
+    if args.suite:
+        return 0 if run_suite(args.max_nodes) else 1
+    if args.epd:
+        return 0 if run_suite(args.max_nodes, epd_suite(args.epd)) else 1
+
+    gs = ChessEngine.GameState(args.fen)
+    start = time.perf_counter()
+    if args.divide:
+        results = divide(gs, args.depth)
+        for notation, nodes in results:
+            print("%s: %d" % (notation, nodes))
+        nodes = sum(nodes for _, nodes in results)
+        print("moves %d" % len(results))
+    else:
+        nodes = perft(gs, args.depth)
+    seconds = time.perf_counter() - start
+    print("depth %d  nodes %d  time %.2fs  %d nps" % (args.depth, nodes, seconds, nodes_per_second(nodes, seconds)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+# Packed binary files of positions and games, read through a memory map so any record is found in O(1)
+# and decoded straight out of the mapped file without copying it.
+#
+# A position is a fixed 32 byte record (little-endian):
+#   0   occupied squares as a 64-bit set, bit = row * 8 + col
+#   8   16 bytes of 4-bit piece indices (ChessBitboard.PIECES), one per occupied square in square order,
+#       the low nibble first
+#   24  flags: bit 0 black to move, bits 1-4 castling rights
+#   25  en passant square, 255 for none
+#   26  white king square, 27 black king square
+#   28  halfmove clock (at most 255), 29 fullmove number (16 bits), 31 unused
+#
+# A position file is a 16 byte header (magic, version, record size, count) and the records.
+# A game file holds the start position and the moves of each game, every move as its 16-bit Move.move_Id:
+#   header (magic, version, record size, count, offset of the start records, offset of the move index)
+#   the moves of all games one after the other
+#   one start record per game
+#   count + 1 64-bit indices into the moves, game i is moves[index[i]:index[i + 1]]
+# The moves and the index are read with memoryview.cast, so these files are written little-endian.
+#
+#   write_positions("positions.bin", game_states)
+#   with PositionFile("positions.bin") as positions: gs = positions.game_state(123456)
+#   write_games("games.bin", finished_game_states)
+#   with GameFile("games.bin") as games: ids = games.moves(42)
+
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+import ChessEngine
+
+RECORD = struct.Struct('<Q16sBBBBBHx')
+RECORD_SIZE = RECORD.size  # 32
+NO_ENPASSANT = 255
+POSITION_HEADER = struct.Struct('<4sHHQ')
+POSITION_MAGIC = b'CHPS'
+GAME_HEADER = struct.Struct('<4sHHQQQ')
+GAME_MAGIC = b'CHGM'
+VERSION = 1
+
+if sys.byteorder != 'little':
+    raise ImportError("ChessRecords maps its files as native little-endian arrays")
+
+
+# the 32 byte record of a position
+def pack_position(gs):
+    occupied = 0
+    nibbles = bytearray(16)
+    squares = []  # (square, piece index) of every piece
+    for index, bb in enumerate(gs.bitboards):
+        occupied |= bb
+        while bb:
+            b = bb & -bb
+            bb ^= b
+            squares.append((b.bit_length() - 1, index))
+    if len(squares) > 32:
+        raise ValueError("a position record holds at most 32 pieces")
+    squares.sort()
+    for i, (_, index) in enumerate(squares):
+        nibbles[i >> 1] |= index << (4 * (i & 1))
+    white_king = gs.white_king_location[0] * 8 + gs.white_king_location[1]
+    black_king = gs.black_king_location[0] * 8 + gs.black_king_location[1]
+    return RECORD.pack(occupied, bytes(nibbles), (not gs.white_to_move) | gs.castling_rights << 1,
+                       gs.enpassant_square if gs.enpassant_square >= 0 else NO_ENPASSANT,
+                       white_king, black_king, min(gs.halfmove_clock, 255), min(gs.fullmove_number, 0xFFFF))
+
+
+# GameState of the record at offset in buffer (bytes, mmap or memoryview, read in place). With gs the
+# position is loaded into that GameState instead of a new one
+def unpack_position(buffer, offset=0, gs=None):
+    occupied, nibbles, flags, enpassant, _, _, halfmove, fullmove = RECORD.unpack_from(buffer, offset)
+    bitboards = [0] * 12
+    i = 0
+    while occupied:
+        b = occupied & -occupied
+        occupied ^= b
+        bitboards[nibbles[i >> 1] >> (4 * (i & 1)) & 15] |= b
+        i += 1
+    if gs is None:
+        gs = ChessEngine.GameState()
+    gs.load_bitboards(bitboards, not flags & 1, flags >> 1 & 15, enpassant if enpassant != NO_ENPASSANT else -1,
+                      halfmove, fullmove)
+    return gs
+
+
+# writes GameStates (any iterable, consumed one at a time) to a position file, returns the count
+def write_positions(path, game_states):
+    count = 0
+    with open(path, 'wb') as f:
+        f.write(POSITION_HEADER.pack(POSITION_MAGIC, VERSION, RECORD_SIZE, 0))
+        for gs in game_states:
+            f.write(pack_position(gs))
+            count += 1
+        f.seek(0)
+        f.write(POSITION_HEADER.pack(POSITION_MAGIC, VERSION, RECORD_SIZE, count))
+    return count
+
+
+# writes games to a game file and returns the count. Each game is a GameState whose move_log holds the
+# moves played, from the start position or the one it was loaded with. The GameState is left as it was
+def write_games(path, games):
+    starts = []
+    index = array('Q', [0])
+    with open(path, 'wb') as f:
+        f.write(bytes(GAME_HEADER.size))
+        for gs in games:
+            moves = list(gs.move_log)
+            for _ in moves:
+                gs.undo_move()
+            starts.append(pack_position(gs))
+            for move in moves:
+                gs.make_move(move)
+            f.write(array('H', [move.move_Id for move in moves]).tobytes())
+            index.append(index[-1] + len(moves))
+        moves_end = GAME_HEADER.size + 2 * index[-1]
+        records_offset = moves_end + (-moves_end % 8)  # keeps the 64-bit index aligned
+        f.write(bytes(records_offset - moves_end))
+        f.write(b"".join(starts))
+        f.write(index.tobytes())
+        f.seek(0)
+        f.write(GAME_HEADER.pack(GAME_MAGIC, VERSION, RECORD_SIZE, len(starts), records_offset,
+                                 records_offset + RECORD_SIZE * len(starts)))
+    return len(starts)
+
+
+# read-only memory map of a whole file, kept with a memoryview of it. The file has to start with header
+# (magic, version, record size, ...), self.header holds its fields. Raises ValueError for any other file
+class MappedFile:
+    def __init__(self, path, header, magic, kind):
+        self.file = open(path, 'rb')
+        self.map = None
+        self.view = None
+        fields = None
+        if os.fstat(self.file.fileno()).st_size >= header.size:  # mmap can't map an empty file
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+            fields = header.unpack_from(self.view, 0)
+        if fields is None or fields[:3] != (magic, VERSION, RECORD_SIZE):
+            self.close()
+            raise ValueError("not a %s file: %s" % (kind, path))
+        self.header = fields
+
+    def close(self):
+        if self.view is not None:
+            self.release_views()
+            self.view.release()
+            self.view = None
+            self.map.close()
+        if not self.file.closed:
+            self.file.close()
+
+    # subclasses release the views they made of self.view here
+    def release_views(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PositionFile(MappedFile):
+    def __init__(self, path):
+        super().__init__(path, POSITION_HEADER, POSITION_MAGIC, "position")
+        self.count = self.header[3]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.game_state(i)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.game_state(i)
+
+    # the raw record of position i, a view into the mapped file
+    def record(self, i):
+        offset = self.offset(i)
+        return self.view[offset:offset + RECORD_SIZE]
+
+    def offset(self, i):
+        if not -self.count <= i < self.count:
+            raise IndexError("position index out of range")
+        return POSITION_HEADER.size + (i % self.count) * RECORD_SIZE
+
+    def game_state(self, i, gs=None):
+        return unpack_position(self.view, self.offset(i), gs)
+
+
+class GameFile(MappedFile):
+    def __init__(self, path):
+        self.index = self.all_moves = None
+        super().__init__(path, GAME_HEADER, GAME_MAGIC, "game")
+        _, _, _, self.count, self.records_offset, index_offset = self.header
+        self.index = self.view[index_offset:index_offset + 8 * (self.count + 1)].cast('Q')
+        self.all_moves = self.view[GAME_HEADER.size:GAME_HEADER.size + 2 * self.index[self.count]].cast('H')
+
+    def release_views(self):
+        if self.index is not None:
+            self.index.release()
+            self.all_moves.release()
+
+    def __len__(self):
+        return self.count
+
+    def check_index(self, i):
+        if not -self.count <= i < self.count:
+            raise IndexError("game index out of range")
+        return i % self.count
+
+    # move_Ids of game i as a memoryview of 16-bit ints into the mapped file
+    def moves(self, i):
+        i = self.check_index(i)
+        return self.all_moves[self.index[i]:self.index[i + 1]]
+
+    def start_position(self, i, gs=None):
+        return unpack_position(self.view, self.records_offset + self.check_index(i) * RECORD_SIZE, gs)
+
+    # GameState of game i after its first plies moves (all of them by default), with the moves in move_log
+    def game_state(self, i, plies=None, gs=None):
+        gs = self.start_position(i, gs)
+        moves = self.moves(i)
+        for move_id in moves[:plies] if plies is not None else moves:
+            gs.make_move(ChessEngine.Move.from_id(move_id, gs.board))
+        return gs
@@ -0,0 +1,352 @@
+# Alpha-beta search built on GameState.make_move/undo_move. Negamax with iterative deepening under a
+# wall clock budget, a transposition table, a capture-only quiescence search at the leaves and move
+# ordering by hash move, MVV-LVA for captures, killer moves and the history heuristic. Moves are taken
+# from GameState.generate_moves stage by stage so cutoffs skip generating the rest.
+#
+#   python ChessSearch.py --time 5
+#   python ChessSearch.py --fen "<fen>" --time 2 --depth 8
+
+import argparse
+import sys
+import time
+
+import ChessEngine
+from ChessBitboard import (FLAG_NONE, FLAG_DOUBLE_PUSH, FLAG_ENPASSANT, FLAG_CASTLE, FLAG_PROMOTION, PIECE_INDEX,
+                           PIECE_SHIFT, CAPTURE_SHIFT, CAPTURE_BITS, code_to_uci, is_tactical_code)
+from ChessEvaluation import evaluate_relative
+from ChessTranspositionTable import TranspositionTable, EXACT, LOWER_BOUND, UPPER_BOUND, NO_MOVE
+
+MATE_SCORE = 100000
+MATE_BOUND = MATE_SCORE - 1000  # anything beyond this is a forced mate
+INFINITY = 1000000
+MAX_PLY = 128
+TIME_CHECK_INTERVAL = 256  # nodes between looks at the clock
+
+# MVV-LVA values by piece kind (pawn, knight, bishop, rook, queen, king): capture the most valuable
+# victim with the least valuable attacker first
+ORDER_VALUES = [1, 3, 3, 5, 9, 20]
+QUEEN_PROMOTION = FLAG_PROMOTION << 12
+KILLER_ORDER = (90000, 80000)
+HISTORY_LIMIT = 50000  # history scores are halved once one passes this, keeping them below the killers
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Search:
+    def __init__(self, info_callback=None, hash_mb=16, tt=None, tablebases=None):
+        self.info_callback = info_callback  # called with an info dict after every completed depth
+        self.tt = tt if tt is not None else TranspositionTable(hash_mb)
+        self.tablebases = tablebases  # ChessTablebase.Tablebases probed for positions with few pieces
+        self.tb_hits = 0
+        self.nodes = 0
+        self.quiescence_nodes = 0  # part of nodes
+        self.beta_cutoffs = 0  # negamax nodes that failed high, and those that did so on their first move
+        self.first_move_cutoffs = 0
+        self.start_time = 0.0
+        self.deadline = 0.0
+        self.node_limit = None
+        self.stopped = False
+        self.killers = [[0, 0] for _ in range(MAX_PLY)]
+        self.history = [0] * 4096  # indexed by the from/to bits of a move code
+        self.pv = [[] for _ in range(MAX_PLY + 1)]  # pv[ply] is the best line found from that ply
+        self.previous_pv = []  # principal variation of the last completed depth, searched first
+        self.info = []  # info dicts of the completed depths of the last search
+
+    # asks a running search to return its best move so far, safe to call from another thread. A stop
+    # holds until prepare is called, so one that comes before the search has started isn't lost
+    def stop(self):
+        self.stopped = True
+
+    # clears an earlier stop, call it from the thread handing out the search before the search starts
+    def prepare(self):
+        self.stopped = False
+
+    # searches the position for at most time_limit seconds (and max_nodes nodes, if given) and returns
+    # the best Move found, or None if the side to move has no legal moves
+    def search(self, gs, time_limit, max_depth=64, max_nodes=None):
+        self.start_time = time.perf_counter()
+        self.deadline = self.start_time + time_limit
+        self.node_limit = max_nodes
+        self.nodes = 0
+        self.quiescence_nodes = 0
+        self.beta_cutoffs = 0
+        self.first_move_cutoffs = 0
+        self.tb_hits = 0
+        self.info = []
+        self.killers = [[0, 0] for _ in range(MAX_PLY)]
+        self.history = [h // 8 for h in self.history]
+        self.previous_pv = []
+        self.tt.new_search()
+        self.tt.reset_stats()
+
+        root_codes = gs.get_valid_move_codes()
+        if not root_codes:
+            return None
+        if self.tablebases is not None:  # known endings are played straight from the tables
+            ranked = self.tablebases.rank_root_moves(gs)
+            if ranked:
+                move, score = ranked[0]
+                self.tb_hits = 1
+                self.report(1, score, [move.code])
+                return move
+        best_code = root_codes[0]
+        log_length = len(gs.move_log)
+        for depth in self.depths(min(max_depth, MAX_PLY - 1)):
+            try:
+                score = self.negamax(gs, depth, -INFINITY, INFINITY, 0)
+            except SearchTimeout:
+                while len(gs.move_log) > log_length:  # unwind the moves the interrupted search had made
+                    gs.undo_move()
+                break
+            best_code = self.pv[0][0]
+            self.previous_pv = list(self.pv[0])
+            elapsed = self.report(depth, score, self.pv[0])
+            if abs(score) > MATE_BOUND or elapsed > time_limit / 2:  # the next depth would not finish in time
+                break
+        return ChessEngine.Move.from_code(best_code)
+
+    # records the info of a completed depth and passes it to the callback, returns the time used so far
+    def report(self, depth, score, pv):
+        elapsed = time.perf_counter() - self.start_time
+        info = {'depth': depth, 'score': score, 'nodes': self.nodes, 'time': elapsed,
+                'nps': int(self.nodes / elapsed) if elapsed > 0 else 0, 'hashfull': self.tt.hashfull(),
+                'tbhits': self.tb_hits, 'pv': [code_to_uci(code) for code in pv]}
+        self.info.append(info)
+        if self.info_callback is not None:
+            self.info_callback(info)
+        return elapsed
+
+    # counters of the last search. cutoff_rate is the share of full-width nodes that failed high and
+    # first_move_cutoff_rate the share of those that did so on the first move searched
+    def stats(self):
+        return {'nodes': self.nodes, 'quiescence_nodes': self.quiescence_nodes, 'beta_cutoffs': self.beta_cutoffs,
+                'cutoff_rate': self.beta_cutoffs / (self.nodes - self.quiescence_nodes or 1),
+                'first_move_cutoff_rate': self.first_move_cutoffs / self.beta_cutoffs if self.beta_cutoffs else 0.0,
+                'tt_probes': self.tt.probes, 'tt_hits': self.tt.hits, 'tb_hits': self.tb_hits,
+                'depth': self.info[-1]['depth'] if self.info else 0}
+
+    # depths iterative deepening goes through, parallel helper searches skip some (see ChessParallel)
+    def depths(self, max_depth):
+        return range(1, max_depth + 1)
+
+    def check_time(self):
+        if (self.stopped or time.perf_counter() > self.deadline or
+                (self.node_limit is not None and self.nodes >= self.node_limit)):
+            raise SearchTimeout()
+
+    def negamax(self, gs, depth, alpha, beta, ply):
+        if depth <= 0:
+            return self.quiescence(gs, alpha, beta, ply)
+        self.nodes += 1
+        if self.nodes % TIME_CHECK_INTERVAL == 0:
+            self.check_time()
+        self.pv[ply] = []
+
+        key = gs.zobrist_key
+        entry = self.tt.probe(key)
+        hash_move_id = NO_MOVE
+        if entry is not None:
+            entry_depth, bound, score, hash_move_id = entry
+            if ply > 0 and entry_depth >= depth:  # the root always searches so it has a move and a pv
+                score = score_from_tt(score, ply)
+                # an exact score inside the window would put this node on the pv, which the table does
+                # not keep, so such nodes are searched (hash move first) to give the pv its full length
+                if (bound != UPPER_BOUND and score >= beta) or (bound != LOWER_BOUND and score <= alpha):
+                    return score
+
+        if (self.tablebases is not None and ply > 0 and
+                (gs.occupancy[0] | gs.occupancy[1]).bit_count() <= self.tablebases.max_pieces):
+            score = self.tablebases.probe_score(gs, ply)
+            if score is not None:
+                self.tb_hits += 1
+                return score
+
+        if ply >= MAX_PLY - 1:
+            return evaluate_relative(gs)
+        in_check = gs.is_in_check()
+        searched_depth = depth
+        if in_check:  # check extension, don't let the horizon hide a mate threat
+            depth += 1
+
+        if hash_move_id != NO_MOVE:
+            first_move = code_from_id(hash_move_id, gs.board)
+        else:
+            first_move = self.previous_pv[ply] if ply < len(self.previous_pv) else 0
+        alpha_original = alpha
+        best_score = -INFINITY
+        best_code = 0
+        # moves come in stages, a cutoff on the hash move generates no stage and one on a capture skips the quiets
+        for searched, code in enumerate(gs.generate_moves(first_move, capture_order, self.quiet_order(ply))):
+            gs.make_move(ChessEngine.Move.from_code(code))
+            score = -self.negamax(gs, depth - 1, -beta, -alpha, ply + 1)
+            gs.undo_move()
+            if score > best_score:
+                best_score = score
+                best_code = code
+            if score > alpha:
+                alpha = score
+                self.pv[ply] = [code] + self.pv[ply + 1]
+                if alpha >= beta:
+                    self.beta_cutoffs += 1
+                    if not searched:
+                        self.first_move_cutoffs += 1
+                    if not is_tactical_code(code):
+                        self.store_killer(code, ply)
+                        self.update_history(code, depth)
+                    break
+        if not best_code:  # no legal moves
+            return -MATE_SCORE + ply if in_check else 0
+
+        if best_score >= beta:
+            bound = LOWER_BOUND
+        elif best_score > alpha_original:
+            bound = EXACT
+        else:
+            bound = UPPER_BOUND
+        self.tt.store(key, searched_depth, bound, score_to_tt(best_score, ply),
+                      ChessEngine.Move.id_from_code(best_code))
+        return best_score
+
+    # only captures and promotions are searched past the horizon, the side to move can stand pat
+    def quiescence(self, gs, alpha, beta, ply):
+        self.nodes += 1
+        self.quiescence_nodes += 1
+        if self.nodes % TIME_CHECK_INTERVAL == 0:
+            self.check_time()
+        self.pv[ply] = []
+        stand_pat = evaluate_relative(gs)
+        if stand_pat >= beta or ply >= MAX_PLY - 1:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        codes = gs.get_valid_move_codes(quiets=False)
+        codes.sort(key=capture_order, reverse=True)
+        for code in codes:
+            gs.make_move(ChessEngine.Move.from_code(code))
+            score = -self.quiescence(gs, -beta, -alpha, ply + 1)
+            gs.undo_move()
+            if score > alpha:
+                alpha = score
+                self.pv[ply] = [code] + self.pv[ply + 1]
+                if alpha >= beta:
+                    break
+        return alpha
+
+    # sort key for the quiet moves at a ply: killer moves first, then by history score
+    def quiet_order(self, ply):
+        killers = self.killers[ply]
+        history = self.history
+
+        def order(code):
+            if code == killers[0]:
+                return KILLER_ORDER[0]
+            if code == killers[1]:
+                return KILLER_ORDER[1]
+            return history[code & 4095]
+
+        return order
+
+    def store_killer(self, code, ply):
+        killers = self.killers[ply]
+        if killers[0] != code:
+            killers[1] = killers[0]
+            killers[0] = code
+
+    def update_history(self, code, depth):
+        history = self.history
+        history[code & 4095] += depth * depth
+        if history[code & 4095] > HISTORY_LIMIT:
+            for i in range(4096):
+                history[i] //= 2
+
+
+# MVV-LVA order of a capture, straight from the piece bits of the move code
+def capture_order(code):
+    captured = code >> CAPTURE_SHIFT
+    score = (10 * ORDER_VALUES[(captured - 1) % 6] if captured else 0) - ORDER_VALUES[(code >> PIECE_SHIFT & 15) % 6]
+    if code & 0xF000 == QUEEN_PROMOTION:  # under promotions sort with the quiet captures
+        score += 10 * ORDER_VALUES[4]
+    return score
+
+
+# mate scores count plies from the root, the table stores them counted from the node instead
+def score_to_tt(score, ply):
+    if score > MATE_BOUND:
+        return score + ply
+    if score < -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score > MATE_BOUND:
+        return score - ply
+    if score < -MATE_BOUND:
+        return score + ply
+    return score
+
+
+# move code of a Move.move_Id in the current position, 0 if there is no piece to move. The code is only
+# a candidate: GameState.generate_moves checks it with is_legal_code before using it
+def code_from_id(move_id, board):
+    low = move_id % 10000  # start and end squares, the 10000s hold the promotion piece
+    start_row, start_col, end_row, end_col = low // 1000, low // 100 % 10, low // 10 % 10, low % 10
+    piece = board[start_row][start_col]
+    if piece == "--":
+        return 0
+    captured = board[end_row][end_col]
+    flag = FLAG_NONE
+    if piece[1] == 'p':  # special moves are told apart from the board the same way Move does it
+        if end_row == 0 or end_row == 7:
+            flag = FLAG_PROMOTION + move_id // 10000
+        elif start_col != end_col and captured == "--":
+            flag = FLAG_ENPASSANT
+            captured = 'bp' if piece == 'wp' else 'wp'
+        elif abs(end_row - start_row) == 2:
+            flag = FLAG_DOUBLE_PUSH
+    elif piece[1] == 'K' and abs(end_col - start_col) == 2:
+        flag = FLAG_CASTLE
+    return ((start_row * 8 + start_col) | (end_row * 8 + end_col) << 6 | flag << 12 |
+            PIECE_INDEX[piece] << PIECE_SHIFT | CAPTURE_BITS[captured])
+
+
+# one line per completed depth, close to the UCI info line
+def format_info(info):
+    score = info['score']
+    if abs(score) > MATE_BOUND:
+        plies = MATE_SCORE - abs(score)
+        score_text = "mate %d" % ((plies + 1) // 2 if score > 0 else -((plies + 1) // 2))
+    else:
+        score_text = "cp %d" % score
+    return "depth %d score %s nodes %d nps %d hashfull %d tbhits %d time %d pv %s" % (
+        info['depth'], score_text, info['nodes'], info['nps'], info['hashfull'], info['tbhits'],
+        int(info['time'] * 1000), " ".join(info['pv']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search a position and print the best move")
+    parser.add_argument("--fen", default=None, help="position to search, defaults to the start position")
+    parser.add_argument("--time", type=float, default=5.0, help="time budget in seconds")
+    parser.add_argument("--depth", type=int, default=64, help="maximum depth")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size in megabytes")
+    parser.add_argument("--tablebases", default=None, help="directory of the ChessTablebase files")
+    args = parser.parse_args(argv)
+
+    gs = ChessEngine.GameState(args.fen)
+    tablebases = None
+    if args.tablebases:
+        from ChessTablebase import Tablebases  # it imports this module for the mate scores
+        tablebases = Tablebases(args.tablebases)
+    search = Search(info_callback=lambda info: print(format_info(info)), hash_mb=args.hash, tablebases=tablebases)
+    move = search.search(gs, args.time, args.depth)
+    print("search %s" % ", ".join("%s %s" % item for item in search.stats().items()))
+    print("tt %s" % ", ".join("%s %s" % item for item in search.tt.stats().items()))
+    print("bestmove %s" % (move.get_uci_notation() if move is not None else "(none)"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+# Endgame tablebases for king and one piece against a lone king (KQvK, KRvK, KPvK). The generator solves
+# each ending by retrograde analysis and writes one byte per position to a local file; the probing layer
+# maps those files and answers win/draw/loss with the distance to mate for any position with at most
+# three pieces (KvK, KNvK and KBvK are draws without a table). Results are kept in an LRU cache keyed by
+# zobrist key. Search probes at interior nodes and plays root moves straight from the tables.
+#
+#   python ChessTablebase.py generate --dir tablebases
+#   python ChessTablebase.py probe --dir tablebases --fen "8/8/8/4k3/8/8/8/4K2R w - - 0 1"
+#
+# Tables are from the point of view of the side with the piece ("strong", white in the file; positions
+# where black has the piece are mirrored top to bottom). Index: strong side to move 0 / weak 1 (1 bit),
+# strong king square, piece square, weak king square (6 bits each). Entry: 0 draw, 255 not a legal
+# position, otherwise distance to mate in plies + 1, so the side to move wins when it is even.
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+
+import ChessEngine
+from ChessSearch import MATE_SCORE
+from ChessBitboard import (WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, KING_ATTACKS, PAWN_ATTACKS,
+                           rook_attacks, queen_attacks, iter_bits)
+
+TABLE_NAMES = {QUEEN: "KQvK", ROOK: "KRvK", PAWN: "KPvK"}
+MAX_PIECES = 3
+DEFAULT_DIRECTORY = "tablebases"
+DEFAULT_CACHE_SIZE = 65536  # probe results kept by the LRU cache
+HEADER = struct.Struct('<4sBcH')
+MAGIC = b'CHTB'
+VERSION = 1
+WEAK_TO_MOVE = 1 << 18
+TABLE_SIZE = 2 * WEAK_TO_MOVE
+ILLEGAL = 255
+WIN, DRAW, LOSS = 1, 0, -1
+
+
+def table_index(strong_to_move, strong_king, piece, weak_king):
+    return (0 if strong_to_move else WEAK_TO_MOVE) | strong_king << 12 | piece << 6 | weak_king
+
+
+def _piece_attacks(kind):
+    if kind == QUEEN:
+        return queen_attacks
+    if kind == ROOK:
+        return rook_attacks
+    return lambda sq, occupied: PAWN_ATTACKS[WHITE][sq]
+
+
+# solves an ending by retrograde analysis and returns its table. KPvK needs the KQvK and KRvK tables for
+# the promotions, passed as promotion_tables {QUEEN: table, ROOK: table}
+def generate(kind, promotion_tables=None):
+    attacks = _piece_attacks(kind)
+    values = bytearray(TABLE_SIZE)
+    counts = bytearray(WEAK_TO_MOVE)  # legal moves of each weak-to-move position not yet known to lose
+    buckets = [[] for _ in range(ILLEGAL)]  # positions by distance to mate, waiting to be expanded
+
+    for wk in range(64):
+        for p in range(64):
+            base = wk << 12 | p << 6
+            if p == wk or (kind == PAWN and not 8 <= p < 56):
+                for bk in range(64):
+                    values[base | bk] = values[WEAK_TO_MOVE | base | bk] = ILLEGAL
+                continue
+            piece_attacks = attacks(p, 1 << wk | 1 << p)
+            strong_attacks = KING_ATTACKS[wk] | piece_attacks
+            for bk in range(64):
+                if bk == wk or bk == p or KING_ATTACKS[wk] >> bk & 1:
+                    values[base | bk] = values[WEAK_TO_MOVE | base | bk] = ILLEGAL
+                    continue
+                in_check = piece_attacks >> bk & 1
+                if in_check:  # the weak king can't be in check with the strong side to move
+                    values[base | bk] = ILLEGAL
+                moves = (KING_ATTACKS[bk] & ~strong_attacks).bit_count()
+                counts[base | bk] = moves
+                if moves == 0 and in_check:
+                    values[WEAK_TO_MOVE | base | bk] = 1
+                    buckets[0].append(WEAK_TO_MOVE | base | bk)
+
+    if kind == PAWN:  # promotions lead into the other tables
+        for wk in range(64):
+            for p in range(8, 16):
+                for bk in range(64):
+                    index = wk << 12 | p << 6 | bk
+                    if values[index] == ILLEGAL or p - 8 in (wk, bk):
+                        continue
+                    best = 0
+                    for table in promotion_tables.values():
+                        value = table[WEAK_TO_MOVE | wk << 12 | (p - 8) << 6 | bk]
+                        if value != ILLEGAL and value and (value - 1) % 2 == 0 and (not best or value + 1 < best):
+                            best = value + 1
+                    if best:
+                        values[index] = best
+                        buckets[best - 1].append(index)
+
+    for distance in range(ILLEGAL - 2):
+        for index in buckets[distance]:
+            if values[index] != distance + 1:  # improved since it was queued
+                continue
+            wk, p, bk = index >> 12 & 63, index >> 6 & 63, index & 63
+            occupied = 1 << wk | 1 << p | 1 << bk
+            if index & WEAK_TO_MOVE:  # weak side lost: every strong move into here wins
+                for previous in _strong_unmoves(kind, attacks, wk, p, bk, occupied):
+                    value = values[previous]
+                    if value != ILLEGAL and (not value or value > distance + 2):
+                        values[previous] = distance + 2
+                        buckets[distance + 1].append(previous)
+            else:  # strong side wins: weak positions lose once all their moves lead to wins
+                for square in iter_bits(KING_ATTACKS[bk] & ~occupied):
+                    previous = WEAK_TO_MOVE | wk << 12 | p << 6 | square
+                    if values[previous] == 0:
+                        counts[previous ^ WEAK_TO_MOVE] -= 1
+                        if not counts[previous ^ WEAK_TO_MOVE]:
+                            values[previous] = distance + 2
+                            buckets[distance + 1].append(previous)
+    return values
+
+
+# strong-to-move positions one strong move before (wk, p, bk)
+def _strong_unmoves(kind, attacks, wk, p, bk, occupied):
+    for square in iter_bits(KING_ATTACKS[wk] & ~occupied & ~KING_ATTACKS[bk]):
+        if not attacks(p, 1 << square | 1 << p) >> bk & 1:
+            yield square << 12 | p << 6 | bk
+    if kind == PAWN:
+        row = p >> 3
+        if row <= 5 and not occupied >> (p + 8) & 1:
+            if not PAWN_ATTACKS[WHITE][p + 8] >> bk & 1:
+                yield wk << 12 | (p + 8) << 6 | bk
+            if row == 4 and not occupied >> (p + 16) & 1 and not PAWN_ATTACKS[WHITE][p + 16] >> bk & 1:
+                yield wk << 12 | (p + 16) << 6 | bk
+    else:
+        for square in iter_bits(attacks(p, occupied) & ~occupied):
+            if not attacks(square, 1 << wk | 1 << square) >> bk & 1:
+                yield wk << 12 | square << 6 | bk
+
+
+def table_path(directory, kind):
+    return os.path.join(directory, TABLE_NAMES[kind] + ".tb")
+
+
+def write_table(path, kind, values):
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, TABLE_NAMES[kind][1].encode(), 0))
+        f.write(values)
+
+
+# generates all the tables into directory, returns their paths
+def generate_all(directory=DEFAULT_DIRECTORY, report=None):
+    os.makedirs(directory, exist_ok=True)
+    tables = {}
+    paths = []
+    for kind in (QUEEN, ROOK, PAWN):
+        tables[kind] = generate(kind, tables)
+        path = table_path(directory, kind)
+        write_table(path, kind, tables[kind])
+        paths.append(path)
+        if report is not None:
+            report(path)
+    return paths
+
+
+class Tablebases:
+    def __init__(self, directory=DEFAULT_DIRECTORY, cache_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.max_pieces = MAX_PIECES  # kings included
+        self.cache = OrderedDict()  # zobrist key -> (wdl, distance to mate in plies), least recent first
+        self.tables = {}  # kind -> mapped table, None if the file is missing
+        self.files = []
+        self.probes = 0
+        self.hits = 0
+
+    def table(self, kind):
+        if kind not in self.tables:
+            self.tables[kind] = None
+            path = table_path(self.directory, kind)
+            if os.path.exists(path):
+                f = open(path, 'rb')
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, version, _, _ = HEADER.unpack_from(mapped, 0)
+                if magic != MAGIC or version != VERSION or len(mapped) != HEADER.size + TABLE_SIZE:
+                    mapped.close()
+                    f.close()
+                    raise ValueError("not a tablebase file: " + path)
+                self.files.append(f)
+                self.tables[kind] = mapped
+        return self.tables[kind]
+
+    # (WIN/DRAW/LOSS for the side to move, plies to mate) or None if the position isn't in the tables
+    def probe(self, gs):
+        if (gs.occupancy[WHITE] | gs.occupancy[BLACK]).bit_count() > self.max_pieces or gs.castling_rights:
+            return None
+        self.probes += 1
+        key = gs.zobrist_key
+        result = self.cache.get(key)
+        if result is not None:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return result
+        result = self.probe_tables(gs)
+        if result is not None and self.cache_size > 0:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def probe_tables(self, gs):
+        bitboards = gs.bitboards
+        for index in (0, 1, 2, 3, 4, 6, 7, 8, 9, 10):  # everything but the kings
+            if bitboards[index]:
+                break
+        else:
+            return DRAW, 0  # bare kings
+        kind = index % 6
+        if kind == KNIGHT or kind == BISHOP:
+            return DRAW, 0
+        table = self.table(kind)
+        if table is None:
+            return None
+        piece = bitboards[index].bit_length() - 1
+        white_king = bitboards[KING].bit_length() - 1
+        black_king = bitboards[6 + KING].bit_length() - 1
+        if index < 6:
+            strong_to_move = gs.white_to_move
+            entry = table_index(strong_to_move, white_king, piece, black_king)
+        else:  # black has the piece, look at the board from the other side
+            strong_to_move = not gs.white_to_move
+            entry = table_index(strong_to_move, black_king ^ 56, piece ^ 56, white_king ^ 56)
+        value = table[HEADER.size + entry]
+        if value == ILLEGAL:
+            return None
+        if value == 0:
+            return DRAW, 0
+        return (WIN if (value - 1) % 2 else LOSS), value - 1
+
+    # the probe as a search score at ply on the ChessSearch mate scale, None if not in the tables
+    def probe_score(self, gs, ply):
+        result = self.probe(gs)
+        if result is None:
+            return None
+        wdl, distance = result
+        return wdl * (MATE_SCORE - ply - distance) if wdl else 0
+
+    # the legal moves of a position in the tables as (Move, score) best first, None if it isn't covered
+    def rank_root_moves(self, gs):
+        if self.probe(gs) is None:
+            return None
+        ranked = []
+        for move in gs.get_valid_moves():
+            gs.make_move(move)
+            score = self.probe_score(gs, 1)
+            gs.undo_move()
+            if score is None:
+                return None
+            ranked.append((move, -score))
+        ranked.sort(key=lambda item: -item[1])
+        return ranked
+
+    def stats(self):
+        return {'probes': self.probes, 'cache_hits': self.hits, 'cached': len(self.cache),
+                'cache_size': self.cache_size}
+
+    def close(self):
+        for mapped in self.tables.values():
+            if mapped is not None:
+                mapped.close()
+        for f in self.files:
+            f.close()
+        self.tables = {}
+        self.files = []
+        self.cache.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate or probe the built-in endgame tablebases")
+    parser.add_argument("command", choices=["generate", "probe"])
+    parser.add_argument("--dir", default=DEFAULT_DIRECTORY, help="directory of the table files")
+    parser.add_argument("--fen", default=None, help="position to probe")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        generate_all(args.dir, lambda path: print("wrote %s" % path))
+        return 0
+    gs = ChessEngine.GameState(args.fen)
+    tablebases = Tablebases(args.dir)
+    result = tablebases.probe(gs)
+    if result is None:
+        print("not in the tables")
+        return 1
+    wdl, distance = result
+    print("%s, mate in %d plies" % ({WIN: "win", DRAW: "draw", LOSS: "loss"}[wdl], distance) if wdl else "draw")
+    for move, score in tablebases.rank_root_moves(gs):
+        print("%-6s %d" % (move.get_uci_notation(), score))
+    tablebases.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
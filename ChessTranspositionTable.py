@@ -0,0 +1,133 @@
+# Fixed size transposition table keyed by GameState.zobrist_key. All entries live in two preallocated
+# arrays of unsigned 64-bit ints, one for keys and one for packed entry data, so memory use is set once
+# by the size in megabytes and never grows. Entries are grouped in buckets of two slots: the first keeps
+# the deepest result (or replaces one left over from an older search), the second is always replaced.
+#
+# Entry data bits: best move as Move.move_Id (16) | score + SCORE_OFFSET (20) | depth (8) | bound (2) | age (8)
+# The key slot stores key ^ data, so an entry whose two words don't belong together reads as a miss. That
+# also makes the table safe to share between processes without locks (see ChessParallel): a slot torn by
+# two writers at once just fails the check.
+
+from array import array
+
+EXACT, LOWER_BOUND, UPPER_BOUND = 1, 2, 3
+ENTRY_BYTES = 16  # one key word and one data word
+BUCKET_SLOTS = 2
+SCORE_OFFSET = 1 << 19
+MAX_DEPTH = 255
+NO_MOVE = 0  # move_Id 0 would be a8 to a8, which is never a move
+
+_MOVE_MASK = 0xFFFF
+_SCORE_SHIFT, _SCORE_MASK = 16, (1 << 20) - 1
+_DEPTH_SHIFT, _DEPTH_MASK = 36, 0xFF
+_BOUND_SHIFT, _BOUND_MASK = 44, 0x3
+_AGE_SHIFT, _AGE_MASK = 46, 0xFF
+
+
+def pack_entry(depth, bound, score, move_id, age):
+    return ((move_id & _MOVE_MASK) | ((score + SCORE_OFFSET) & _SCORE_MASK) << _SCORE_SHIFT |
+            min(depth, MAX_DEPTH) << _DEPTH_SHIFT | bound << _BOUND_SHIFT | (age & _AGE_MASK) << _AGE_SHIFT)
+
+
+# returns (depth, bound, score, move_id) of a packed entry
+def unpack_entry(data):
+    return (data >> _DEPTH_SHIFT & _DEPTH_MASK, data >> _BOUND_SHIFT & _BOUND_MASK,
+            (data >> _SCORE_SHIFT & _SCORE_MASK) - SCORE_OFFSET, data & _MOVE_MASK)
+
+
+def bucket_count(size_mb):
+    return max(1, int(size_mb * 1024 * 1024) // (ENTRY_BYTES * BUCKET_SLOTS))
+
+
+# bytes of memory a table of size_mb needs, the size of the buffer to give TranspositionTable
+def table_bytes(size_mb):
+    return bucket_count(size_mb) * BUCKET_SLOTS * ENTRY_BYTES
+
+
+class TranspositionTable:
+    # with a buffer (e.g. the buf of a multiprocessing.shared_memory block of table_bytes(size_mb)) the
+    # entries are kept in it in place, so every table built on the same block sees the same entries
+    def __init__(self, size_mb=16, buffer=None):
+        self.size_mb = size_mb
+        self.bucket_count = bucket_count(size_mb)
+        self.slot_count = self.bucket_count * BUCKET_SLOTS
+        if buffer is None:
+            self.keys = array('Q', bytes(8 * self.slot_count))
+            self.data = array('Q', bytes(8 * self.slot_count))
+        else:
+            words = memoryview(buffer).cast('Q')
+            self.keys = words[:self.slot_count]
+            self.data = words[self.slot_count:2 * self.slot_count]
+        self.age = 0
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+
+    # call once per search so entries from earlier searches lose their depth-preferred protection
+    def new_search(self):
+        self.age = (self.age + 1) & _AGE_MASK
+
+    def clear(self):
+        self.keys[:] = array('Q', bytes(8 * self.slot_count))
+        self.data[:] = array('Q', bytes(8 * self.slot_count))
+        self.age = 0
+        self.reset_stats()
+
+    # drops the views of a shared buffer so its owner can close it, the table is unusable afterwards
+    def release(self):
+        if isinstance(self.keys, memoryview):
+            self.keys.release()
+            self.data.release()
+
+    def reset_stats(self):
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+
+    # returns (depth, bound, score, move_id) stored for the key or None
+    def probe(self, key):
+        self.probes += 1
+        slot = (key % self.bucket_count) * BUCKET_SLOTS
+        keys = self.keys
+        data = self.data
+        for i in range(slot, slot + BUCKET_SLOTS):
+            entry = data[i]
+            if entry and keys[i] ^ entry == key:
+                self.hits += 1
+                return unpack_entry(entry)
+        return None
+
+    def store(self, key, depth, bound, score, move_id=NO_MOVE):
+        self.stores += 1
+        slot = (key % self.bucket_count) * BUCKET_SLOTS
+        keys = self.keys
+        data = self.data
+        entry = pack_entry(depth, bound, score, move_id, self.age)
+        old = data[slot]
+        same_key = old and keys[slot] ^ old == key
+        if (not old or same_key or depth >= (old >> _DEPTH_SHIFT & _DEPTH_MASK) or
+                (old >> _AGE_SHIFT & _AGE_MASK) != self.age):
+            if same_key and move_id == NO_MOVE:  # keep the best move we already knew
+                entry = pack_entry(depth, bound, score, old & _MOVE_MASK, self.age)
+            if not same_key and old:  # the depth-preferred entry is pushed down to the always-replace slot
+                keys[slot + 1] = keys[slot]
+                data[slot + 1] = old
+            keys[slot] = key ^ entry
+            data[slot] = entry
+        else:
+            keys[slot + 1] = key ^ entry
+            data[slot + 1] = entry
+
+    # permille of sampled slots in use, as in the UCI hashfull info
+    def hashfull(self, sample=1000):
+        sample = min(sample, self.slot_count)
+        used = 0
+        for i in range(sample):
+            if self.data[i]:
+                used += 1
+        return used * 1000 // sample
+
+    def stats(self):
+        return {'size_mb': self.size_mb, 'entries': self.slot_count, 'probes': self.probes, 'hits': self.hits,
+                'hit_rate': self.hits / self.probes if self.probes else 0.0, 'stores': self.stores,
+                'fill': self.hashfull() / 1000}
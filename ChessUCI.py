@@ -0,0 +1,357 @@
+# UCI front end, so the engine runs headless under tournament managers and GUIs:
+#
+#   python ChessUCI.py
+#   python ChessUCI.py --check       runs the scripted sessions of CHECK_SESSIONS and exits non-zero on a hang
+#
+# Commands are read from stdin and answers written to stdout by an asyncio event loop. The search runs
+# in a worker thread (its helper processes too with Threads > 1, see ChessParallel), so the loop keeps
+# answering isready and acts on stop while a long search is going. Nothing here imports pygame.
+
+import argparse
+import asyncio
+import concurrent.futures
+import sys
+import threading
+
+import ChessEngine
+from ChessBook import OpeningBook
+from ChessParallel import ParallelSearch
+from ChessPerft import START_FEN
+from ChessSearch import format_info
+from ChessTablebase import Tablebases, DEFAULT_CACHE_SIZE
+
+ENGINE_NAME = "Chess-Engine"
+ENGINE_AUTHOR = "Arjune7"
+DEFAULT_HASH_MB = 16
+MAX_HASH_MB = 4096
+MAX_THREADS = 256
+DEFAULT_MOVES_TO_GO = 30  # moves the remaining clock time is shared over when the GUI doesn't say
+MOVE_OVERHEAD = 0.05  # seconds kept back from every move for the GUI and the pipes
+CHECK_TIMEOUT = 10.0  # seconds a scripted session may take
+# sessions whose searches must all end with a bestmove: stop straight after go has to reach the search
+# even when the worker thread hasn't started it yet
+CHECK_SESSIONS = [
+    ["position startpos", "go infinite", "stop", "quit"],
+    ["position startpos", "go infinite", "stop", "go infinite", "stop", "quit"],
+    ["setoption name Threads value 2", "position startpos", "go infinite", "stop", "go movetime 100", "quit"],
+]
+GO_PARAMETERS = ('wtime', 'btime', 'winc', 'binc', 'movestogo', 'depth', 'nodes', 'mate', 'movetime',
+                 'infinite', 'ponder', 'searchmoves')
+
+
+# the legal move of a position written in UCI notation (e2e4, e7e8q), None if there is none
+def move_from_uci(gs, text):
+    text = text.lower()
+    for move in gs.get_valid_moves():
+        if move.get_uci_notation() == text:
+            return move
+    return None
+
+
+# seconds to spend on a move from the go parameters, side is 'w' or 'b'
+def time_for_move(limits, side):
+    if 'movetime' in limits:
+        return max(0.0, limits['movetime'] / 1000 - MOVE_OVERHEAD)
+    if side + 'time' not in limits:
+        return float('inf')
+    remaining = limits[side + 'time'] / 1000
+    increment = limits.get(side + 'inc', 0) / 1000
+    budget = remaining / limits.get('movestogo', DEFAULT_MOVES_TO_GO) + 0.75 * increment
+    return max(0.01, min(budget, remaining - MOVE_OVERHEAD))
+
+
+# go parameters as a dict of ints, plus 'infinite'/'ponder' set to True when given
+def parse_go(tokens):
+    limits = {}
+    i = 0
+    while i < len(tokens):
+        name = tokens[i]
+        if name in ('infinite', 'ponder'):
+            limits[name] = True
+        elif name == 'searchmoves':  # not supported, skip the moves
+            while i + 1 < len(tokens) and tokens[i + 1] not in GO_PARAMETERS:
+                i += 1
+        elif name in GO_PARAMETERS and i + 1 < len(tokens):
+            i += 1
+            try:
+                limits[name] = int(tokens[i])
+            except ValueError:
+                pass
+        i += 1
+    return limits
+
+
+class UCIEngine:
+    def __init__(self, write):
+        self.write = write  # called with each output line, on the event loop
+        self.gs = ChessEngine.GameState()
+        self.hash_mb = DEFAULT_HASH_MB
+        self.threads = 1
+        self.book = None  # OpeningBook of the BookFile option
+        self.tablebase_path = None  # TablebasePath option, no tablebases when None
+        self.tablebase_cache = DEFAULT_CACHE_SIZE
+        self.tablebases = None
+        self.searcher = None  # ParallelSearch, made on first use and again after an option changes
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        self.search_task = None
+        self.stop_requested = None
+        self.loop = None
+
+    # handles one line of input, returns False after quit
+    async def handle(self, line):
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, arguments = tokens[0], tokens[1:]
+        if command == 'uci':
+            self.write("id name " + ENGINE_NAME)
+            self.write("id author " + ENGINE_AUTHOR)
+            self.write("option name Hash type spin default %d min 1 max %d" % (DEFAULT_HASH_MB, MAX_HASH_MB))
+            self.write("option name Threads type spin default 1 min 1 max %d" % MAX_THREADS)
+            self.write("option name BookFile type string default <empty>")
+            self.write("option name TablebasePath type string default <empty>")
+            self.write("option name TablebaseCache type spin default %d min 0 max 16777216" % DEFAULT_CACHE_SIZE)
+            self.write("uciok")
+        elif command == 'isready':
+            self.write("readyok")
+        elif command == 'setoption':
+            await self.wait_for_search()
+            self.set_option(arguments)
+        elif command == 'ucinewgame':
+            await self.wait_for_search()
+            if self.searcher is not None:
+                self.searcher.tt.clear()
+            self.gs = ChessEngine.GameState()
+        elif command == 'position':
+            await self.wait_for_search()
+            self.set_position(arguments)
+        elif command == 'go':
+            await self.wait_for_search()
+            self.start_search(parse_go(arguments))
+        elif command == 'stop':
+            await self.wait_for_search()
+        elif command == 'ponderhit':
+            pass
+        elif command == 'quit':
+            await self.wait_for_search()
+            self.close()
+            return False
+        return True
+
+    def set_option(self, arguments):
+        text = " ".join(arguments)
+        name, _, value = text.partition(" value ")
+        name = name.replace("name", "", 1).strip().lower()
+        if name == 'bookfile':
+            self.set_book(value.strip())
+            return
+        if name == 'tablebasepath':
+            value = value.strip()
+            self.tablebase_path = value if value and value != "<empty>" else None
+        else:
+            try:
+                value = int(value)
+            except ValueError:
+                return
+            if name == 'hash':
+                self.hash_mb = min(max(1, value), MAX_HASH_MB)
+            elif name == 'threads':
+                self.threads = min(max(1, value), MAX_THREADS)
+            elif name == 'tablebasecache':
+                self.tablebase_cache = max(0, value)
+            else:
+                return
+        self.close_searcher()
+
+    def set_book(self, path):
+        if self.book is not None:
+            self.book.close()
+            self.book = None
+        if path and path != "<empty>":
+            try:
+                self.book = OpeningBook(path)
+            except OSError as error:
+                self.write("info string can't open book: %s" % error)
+
+    # position startpos|fen <fen> [moves <move> ...]
+    def set_position(self, arguments):
+        if 'moves' in arguments:
+            split = arguments.index('moves')
+            setup, moves = arguments[:split], arguments[split + 1:]
+        else:
+            setup, moves = arguments, []
+        if setup[:1] == ['fen']:
+            fen = " ".join(setup[1:])
+        else:
+            fen = START_FEN
+        try:
+            gs = ChessEngine.GameState(fen)
+        except ValueError as error:
+            self.write("info string bad position: %s" % error)
+            return
+        for text in moves:
+            move = move_from_uci(gs, text)
+            if move is None:
+                self.write("info string illegal move %s" % text)
+                break
+            gs.make_move(move)
+        self.gs = gs
+
+    def start_search(self, limits):
+        if self.book is not None and not limits.get('infinite'):
+            move = self.book.choose(self.gs)
+            if move is not None:
+                self.write("info string book move")
+                self.write("bestmove " + move.get_uci_notation())
+                return
+        if self.searcher is None:
+            if self.tablebase_path is not None:
+                self.tablebases = Tablebases(self.tablebase_path, self.tablebase_cache)
+            self.searcher = ParallelSearch(self.threads, self.report, self.hash_mb, self.tablebases)
+        self.searcher.prepare()  # here, not in the worker thread, so a stop right after go isn't wiped out
+        self.loop = asyncio.get_running_loop()
+        self.stop_requested = asyncio.Event()
+        self.search_task = asyncio.ensure_future(self.run_search(self.gs, limits))
+
+    # runs in the worker thread through the search's info callback
+    def report(self, info):
+        self.loop.call_soon_threadsafe(self.write, "info " + format_info(info))
+
+    async def run_search(self, gs, limits):
+        time_limit = time_for_move(limits, 'w' if gs.white_to_move else 'b')
+        max_depth = limits.get('depth', 64)
+        if 'mate' in limits:
+            max_depth = min(max_depth, 2 * limits['mate'])
+        try:
+            move = await self.loop.run_in_executor(self.executor, self.searcher.search, gs, time_limit, max_depth,
+                                                   limits.get('nodes'))
+        except Exception as error:  # the engine keeps running, the GUI gets no move for this position
+            self.write("info string search failed: %s: %s" % (type(error).__name__, error))
+            move = None
+        if limits.get('infinite') or limits.get('ponder'):  # bestmove only once the GUI says stop
+            await self.stop_requested.wait()
+        self.write("bestmove " + (move.get_uci_notation() if move is not None else "0000"))
+
+    # stops a running search and waits for its bestmove to be written
+    async def wait_for_search(self):
+        if self.search_task is None:
+            return
+        self.searcher.stop()
+        self.stop_requested.set()
+        await self.search_task
+        self.search_task = None
+
+    # the search is made again on the next go with the current options
+    def close_searcher(self):
+        if self.searcher is not None:
+            self.searcher.close()
+            self.searcher = None
+        if self.tablebases is not None:
+            self.tablebases.close()
+            self.tablebases = None
+
+    # a search still running is stopped and waited for before its tables are freed
+    def close(self):
+        if self.searcher is not None:
+            self.searcher.stop()
+        self.executor.shutdown()
+        self.set_book(None)
+        self.close_searcher()
+
+
+# asyncio stream of stdin. Pipes and terminals are watched by the event loop directly, anything the loop
+# can't poll (a redirected regular file) is fed in by a reading thread
+async def open_stdin(loop):
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except (ValueError, OSError):
+        def feed():
+            for line in sys.stdin.buffer:
+                loop.call_soon_threadsafe(reader.feed_data, line)
+            loop.call_soon_threadsafe(reader.feed_eof)
+
+        threading.Thread(target=feed, daemon=True).start()
+    return reader
+
+
+# asyncio writer of stdout, or None where stdout can't be written through the event loop
+async def open_stdout(loop):
+    try:
+        transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, sys.stdout)
+    except (ValueError, OSError):
+        return None
+    return asyncio.StreamWriter(transport, protocol, None, loop)
+
+
+async def run():
+    loop = asyncio.get_running_loop()
+    reader = await open_stdin(loop)
+    writer = await open_stdout(loop)
+
+    def write(line):
+        if writer is not None:
+            writer.write(line.encode() + b"\n")
+        else:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+    engine = UCIEngine(write)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:  # end of input counts as quit
+                await engine.handle("quit")
+                break
+            if not await engine.handle(line.decode(errors='replace')):
+                break
+    finally:  # frees the shared hash table even when a command failed
+        await engine.wait_for_search()
+        engine.close()
+    if writer is not None:
+        await writer.drain()
+        writer.close()
+
+
+# runs one scripted session through a UCIEngine, returns the bestmove lines or None if it didn't finish
+async def run_session(lines, timeout=CHECK_TIMEOUT):
+    output = []
+    engine = UCIEngine(output.append)
+
+    async def session():
+        for line in lines:
+            if not await engine.handle(line):
+                break
+
+    try:
+        await asyncio.wait_for(session(), timeout)
+    except asyncio.TimeoutError:
+        await engine.handle("quit")  # stops the hung search and closes the engine
+        return None
+    return [line for line in output if line.startswith("bestmove")]
+
+
+# 0 if every session of CHECK_SESSIONS answers each go with a bestmove in time
+def check():
+    failures = 0
+    for lines in CHECK_SESSIONS:
+        bestmoves = asyncio.run(run_session(lines))
+        expected = sum(1 for line in lines if line.startswith("go"))
+        ok = bestmoves is not None and len(bestmoves) == expected
+        failures += not ok
+        print("%-4s %s" % ("ok" if ok else "FAIL", " / ".join(lines)))
+    return 1 if failures else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="UCI engine on stdin/stdout")
+    parser.add_argument("--check", action="store_true", help="run the scripted go/stop sessions and exit")
+    args = parser.parse_args(argv)
+    if args.check:
+        return check()
+    asyncio.run(run())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
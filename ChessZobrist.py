@@ -0,0 +1,32 @@
+# Zobrist keys: every (piece, square), the side to move, each castling rights combination and each
+# en passant file gets a random 64-bit number and a position's key is the XOR of the ones that apply.
+# GameState keeps its key up to date by XORing the differences in make_move/undo_move.
+# The generator is seeded so keys are the same in every process, which hash tables and book files rely on.
+
+import random
+
+_rng = random.Random(0x5EED0C4E55)
+
+PIECE_KEYS = [[_rng.getrandbits(64) for _ in range(64)] for _ in range(12)]  # indexed like GameState.bitboards
+SIDE_KEY = _rng.getrandbits(64)  # XORed in when black is to move
+CASTLING_KEYS = [_rng.getrandbits(64) for _ in range(16)]  # indexed by the castling rights bits
+CASTLING_KEYS[0] = 0
+_file_keys = [_rng.getrandbits(64) for _ in range(8)]
+# indexed by the en passant square, the extra last entry is 0 so enpassant_square == -1 adds nothing
+ENPASSANT_KEYS = [_file_keys[sq & 7] for sq in range(64)] + [0]
+
+
+# key of a position computed from scratch
+def compute_key(gs):
+    key = 0
+    for index, bb in enumerate(gs.bitboards):
+        keys = PIECE_KEYS[index]
+        while bb:
+            b = bb & -bb
+            bb ^= b
+            key ^= keys[b.bit_length() - 1]
+    if not gs.white_to_move:
+        key ^= SIDE_KEY
+    key ^= CASTLING_KEYS[gs.castling_rights]
+    key ^= ENPASSANT_KEYS[gs.enpassant_square]
+    return key